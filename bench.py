@@ -0,0 +1,420 @@
+#! /usr/bin/python
+
+"""
+Benchmarks of the test harness itself, run without TDE and the API installed.
+swifttest and LdxCmd are replaced with the stubs from the ./stubs folder.
+
+  bench.py suite   generates synthetic project trees and py/tde obj trees at several scales and times
+                   dig_tests(), check(), compare_ini(), Table.output() and the whole per-project pipeline
+                   separately. The results are written as JSON to track regressions of the harness.
+  bench.py ini     compares the time of the ConfigParser-based INI diff against IniFile and diff_ini().
+  bench.py selftest
+                   checks the concurrency paths of the harness against the stubs: the startup probe,
+                   timeouts and restarts of the persistent LdxCmd server, the replies and worker deaths
+                   of the API compile service seen from forked clients, the NumPy and plain Python
+                   comparisons of ValueMatrix.
+"""
+
+from __future__ import print_function
+import argparse
+import ConfigParser
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+STUBS_DIR = os.path.join(BENCH_DIR, 'stubs')
+
+# the harness is benchmarked against the stub toolchain
+sys.path.insert(1, STUBS_DIR)
+import test
+
+
+#
+# Scales of the suite: number of projects in the project tree, number of projects run through the pipeline,
+# port folders per obj tree, INI files per port, sections per INI file and keys per section
+#
+SCALES = {
+    'small': dict(projects=20, pipeline_projects=4, ports=2, ini_files=3, sections=5, keys=50),
+    'medium': dict(projects=200, pipeline_projects=8, ports=8, ini_files=4, sections=10, keys=200),
+    'large': dict(projects=1000, pipeline_projects=4, ports=16, ini_files=5, sections=20, keys=500),
+}
+UNEQUAL_SHARE = 0.01
+
+
+def write_ini(path, sections, keys, unequal, seed):
+    """Write a synthetic INI file. 'unequal' is the share of values which depend on 'seed'."""
+    rnd = random.Random(0)
+    with open(path, 'w') as fp:
+        for s in range(sections):
+            fp.write('[Section%d]\n' % s)
+            for k in range(keys):
+                value = rnd.randint(0, 1 << 16)
+                if rnd.random() < unequal:
+                    value += seed
+                fp.write('Option%d=%d\n' % (k, value))
+
+
+def make_ini_tree(path, ports, ini_files, sections, keys, seed, port_sep='_'):
+    """Create port folders with synthetic INI files as compiled by the API (port_sep '_') or LdxCmd (' ')."""
+    for p in range(ports):
+        port_dir = os.path.join(path, port_sep.join(('Client', 'Port', str(p + 1))))
+        os.makedirs(port_dir)
+        for i in range(ini_files):
+            write_ini(os.path.join(port_dir, 'File%d%d.ini' % (i, p + 1)), sections, keys, UNEQUAL_SHARE, seed)
+
+
+def make_project_tree(path, projects, ini_projects=0, ports=0, ini_files=0, sections=0, keys=0):
+    """
+    Create a tree of synthetic TDE projects nested in groups of 10 projects per folder,
+    the first 'ini_projects' of them get an 'ini' folder consumed by the stub toolchain.
+    Return the list of the project folders.
+    """
+    result = list()
+    for n in range(projects):
+        project_dir = os.path.join(path, 'group%d' % (n // 100), 'sub%d' % (n // 10), 'project%d' % n)
+        os.makedirs(os.path.join(project_dir, 'resources'))
+        open(os.path.join(project_dir, 'project%d.swift_test' % n), 'w').close()
+        open(os.path.join(project_dir, 'resources', 'data.bin'), 'w').close()
+        open(os.path.join(project_dir, '.hidden'), 'w').close()
+        if n < ini_projects:
+            make_ini_tree(os.path.join(project_dir, 'ini'), ports, ini_files, sections, keys, 0, port_sep=' ')
+        result.append(project_dir)
+    return result
+
+
+def make_ldxcmd(path):
+    """Write a launcher of stubs/LdxCmd using the current interpreter and return its path."""
+    ldxcmd = os.path.join(path, 'LdxCmd')
+    with open(ldxcmd, 'w') as fp:
+        fp.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, os.path.join(STUBS_DIR, 'LdxCmd')))
+    os.chmod(ldxcmd, 0o755)
+    return ldxcmd
+
+
+class Quiet:
+    """Redirect stdout and stderr to /dev/null."""
+    def __enter__(self):
+        self.devnull = open(os.devnull, 'w')
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = self.devnull
+
+    def __exit__(self, *exc):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        self.devnull.close()
+
+
+def measure(func, repeat):
+    """Return the best wall time of 'repeat' calls of 'func' in seconds."""
+    with Quiet():
+        return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def bench_scale(name, params, repeat):
+    temp_dir = tempfile.mkdtemp()
+    cur_dir = os.getcwd()
+    try:
+        timings = dict()
+        print('%s: %s' % (name, ', '.join('%s=%s' % item for item in sorted(params.items()))))
+
+        tree_dir = os.path.join(temp_dir, 'projects')
+        make_project_tree(tree_dir, params['projects'], params['pipeline_projects'], params['ports'],
+                          params['ini_files'], params['sections'], params['keys'])
+        timings['dig_tests'] = measure(lambda: list(test.dig_tests(tree_dir)), repeat)
+
+        obj_dirs = [os.path.join(temp_dir, build, 'obj', 'project') for build in ('py', 'tde')]
+        for seed, obj_dir in enumerate(obj_dirs):
+            make_ini_tree(obj_dir, params['ports'], params['ini_files'], params['sections'], params['keys'], seed)
+        timings['check'] = measure(lambda: test.check(obj_dirs), repeat)
+
+        ini_dirs = set(os.path.join(obj_dir, 'Client_Port_1') for obj_dir in obj_dirs)
+        timings['compare_ini'] = measure(lambda: test.compare_ini(ini_dirs, 'File01.ini', test.ReportSink()),
+                                         repeat)
+
+        table = test.Table('File01.ini')
+        table.add_header(['', 'py', 'tde', 'status'])
+        for n in range(params['sections'] * params['keys']):
+            table.add_row(test.Row(['  Option%d' % n, str(n), str(n + 1), 'unequal'], font='Red'))
+        table.add_sep()
+        timings['Table.output'] = measure(table.output, repeat)
+
+        # the pipeline writes AutomationConfig and obj trees to the current folder
+        work_dir = os.path.join(temp_dir, 'work')
+        os.makedirs(work_dir)
+        os.chdir(work_dir)
+        ldxcmd_bin = make_ldxcmd(temp_dir)
+        args = test.get_arg_parser().parse_args([tree_dir, '--no-cache'])
+        pipeline_dirs = list(test.dig_tests(tree_dir))[:params['pipeline_projects']]
+        timings['process_project'] = measure(
+            lambda: [test.process_project(ldxcmd_bin, project_dir, args) for project_dir in pipeline_dirs],
+            repeat) / max(len(pipeline_dirs), 1)
+
+        for stage in sorted(timings):
+            print('  %-16s %10.1f ms' % (stage, timings[stage] * 1000))
+        return dict(params=params, timings=timings)
+    finally:
+        os.chdir(cur_dir)
+        shutil.rmtree(temp_dir)
+
+
+def bench_suite(scales, repeat, output):
+    test.get_exception_rules()
+    results = dict(timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                   platform=platform.platform(), repeat=repeat, scales=dict())
+    for name in scales:
+        results['scales'][name] = bench_scale(name, SCALES[name], repeat)
+    with open(output, 'w') as fp:
+        json.dump(results, fp, indent=2, sort_keys=True)
+    print('Results written to %s' % output)
+
+
+def diff_configparser(paths):
+    """The ConfigParser-based diff as it used to be done in compare_ini(). Return a list of unequal options."""
+    configs = list()
+    for path in paths:
+        configs.append(ConfigParser.RawConfigParser())
+        configs[-1].read(path)
+    conf_structure = dict()
+    for conf in configs:
+        for section in conf.sections():
+            if not conf_structure.has_key(section):
+                conf_structure[section] = set()
+            conf_structure[section] |= set(conf.options(section))
+    result = list()
+    for section in conf_structure:
+        for option in conf_structure[section]:
+            values = list()
+            values.append(option)
+            for conf in configs:
+                if conf.has_section(section) and conf.has_option(section, option):
+                    values.append(conf.get(section, option))
+                else:
+                    values.append('-')
+            if len(set(values)) > 2:
+                result.append((section, option))
+    return result
+
+
+def diff_inifile(paths):
+    """The IniFile/diff_ini() diff. Return a list of unequal options."""
+    configs = [test.IniFile(path) for path in paths]
+    result = list()
+    for section, presence, option_values in test.diff_ini(configs):
+        for option, values in option_values:
+            result.append((section, option))
+    return result
+
+
+def bench_ini(sections, keys, unequal, repeat):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        paths = [os.path.join(temp_dir, 'Port%d.ini' % n) for n in range(2)]
+        for n, path in enumerate(paths):
+            write_ini(path, sections, keys, unequal, n)
+        if sorted(diff_configparser(paths)) != sorted(diff_inifile(paths)):
+            raise Exception('ConfigParser and IniFile results differ.')
+        print('%d sections x %d keys, %d%% unequal:' % (sections, keys, unequal * 100))
+        for name, func in (('ConfigParser', diff_configparser), ('IniFile', diff_inifile)):
+            elapsed = min(timeit.repeat(lambda: func(paths), number=1, repeat=repeat))
+            print('  %-12s %8.1f ms' % (name, elapsed * 1000))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def expect_error(func, error, text):
+    """Call 'func' and check that it raises 'error' with 'text' in the message."""
+    try:
+        func()
+    except error as e:
+        if text not in str(e):
+            raise Exception('Unexpected error message: %s' % e)
+    else:
+        raise Exception('%s has not been raised.' % error.__name__)
+
+
+def check_ldxcmd_driver(temp_dir):
+    """PersistentLdxCmdDriver: the startup probe, the timeout and the restart of a killed or dead server."""
+    os.makedirs(temp_dir)
+    ldxcmd_bin = make_ldxcmd(temp_dir)
+    os.environ['LDXCMD_NO_SERVER'] = '1'
+    try:
+        expect_error(test.PersistentLdxCmdDriver(ldxcmd_bin).probe, Exception, 'does not support --server')
+    finally:
+        del os.environ['LDXCMD_NO_SERVER']
+
+    project_dir = make_project_tree(os.path.join(temp_dir, 'projects'), 1)[0]
+    generate = ['--generate', '--project:' + os.path.join(project_dir, 'project0.swift_test'),
+                '--out:' + os.path.join(temp_dir, 'AutomationConfig')]
+    driver = test.PersistentLdxCmdDriver(ldxcmd_bin)
+
+    def check_server():
+        if driver.start(generate).wait():
+            raise Exception('LdxCmd server has failed to run a command.')
+
+    try:
+        driver.probe()
+        check_server()
+        started = time.time()
+        expect_error(driver.start(['--sleep:10'], timeout=0.5).wait, test.ToolTimeout, 'has been killed')
+        if time.time() - started > 5:
+            raise Exception('LdxCmd server has not been killed in time.')
+        check_server()
+        # the time spent waiting for a tool slot does not count against the timeout
+        test.set_tool_limit(1)
+        try:
+            requests = [driver.start(['--sleep:0.5'], timeout=1.0) for n in range(3)]
+            for request in requests:
+                request.wait()
+        finally:
+            test.set_tool_limit(0)
+        expect_error(driver.start(['--exit:3']).wait, Exception, 'terminated unexpectedly')
+        check_server()
+    finally:
+        driver.close()
+
+
+def compile_client(job):
+    """A client of the CompileService forked by check_compile_service(). Return (error, compile_api() errors)."""
+    try:
+        with Quiet():
+            return None, test.compile_api(*job)
+    except Exception as e:
+        return str(e), None
+
+
+def check_compile_service(temp_dir):
+    """CompileService: the replies to several forked clients and the death of a worker seen by all of them."""
+    import multiprocessing
+    os.makedirs(temp_dir)
+    ldxcmd = test.LdxCmdDriver(make_ldxcmd(temp_dir))
+    # the last project has no 'ini' folder and fails to compile
+    project_dirs = make_project_tree(os.path.join(temp_dir, 'projects'), 3, 2, 1, 1, 2, 3)
+    jobs = list()
+    for n, project_dir in enumerate(project_dirs):
+        project_name = os.path.basename(project_dir)
+        project_file = os.path.join(project_dir, project_name + '.swift_test')
+        config_dir = os.path.join(temp_dir, 'AutomationConfig', project_name)
+        returncode, output = ldxcmd.run(['--generate', '--project:' + project_file, '--out:' + config_dir])
+        if returncode:
+            raise Exception(output)
+        jobs.append((project_name, os.path.join(config_dir, 'AutomationConfig.xml'),
+                     os.path.join(temp_dir, 'py', 'obj', project_name)))
+
+    def run_clients(job_list, clients):
+        # the clients are forked after the service has been started
+        pool = multiprocessing.Pool(clients)
+        try:
+            return pool.map_async(compile_client, job_list, chunksize=1).get(30)
+        except multiprocessing.TimeoutError:
+            raise Exception('The API compile clients have not got their replies.')
+        finally:
+            pool.terminate()
+            pool.join()
+
+    test.start_compile_service(2)
+    try:
+        results = run_clients(jobs * 4, 3)
+    finally:
+        test.stop_compile_service()
+    for (project_name, config_xml, obj_dir), (error, errors) in zip(jobs * 4, results):
+        if error:
+            raise Exception(error)
+        if project_name == jobs[-1][0]:
+            if len(errors) != 1 or sorted(errors[0]) != ['source', 'text'] or errors[0]['source'] != config_xml:
+                raise Exception('Unexpected errors of %s: %s' % (project_name, errors))
+        elif errors or not os.path.isdir(os.path.join(obj_dir, 'Client_Port_1')):
+            raise Exception('%s has not been compiled: %s' % (project_name, errors))
+
+    os.environ['SWIFTTEST_CRASH'] = jobs[1][0]
+    try:
+        test.start_compile_service(1)
+        try:
+            results = run_clients([jobs[1], jobs[0]], 2)
+        finally:
+            test.stop_compile_service()
+    finally:
+        del os.environ['SWIFTTEST_CRASH']
+    # the other project may have been compiled before the crash
+    for n, (error, errors) in enumerate(results):
+        if (error or not n) and 'exited unexpectedly' not in str(error):
+            raise Exception('The death of the API compile worker has not been reported: %s' % error)
+
+
+def check_value_matrix(temp_dir):
+    """ValueMatrix: the NumPy comparison of the builds finds the same rows as the plain Python one."""
+    os.makedirs(temp_dir)
+    # the last build lacks some sections, so that absent options are compared too
+    paths = [os.path.join(temp_dir, 'Port%d.ini' % n) for n in range(4)]
+    for n, path in enumerate(paths):
+        write_ini(path, 10 if n < 3 else 7, 50, 0.05, n % 3)
+    configs = [test.IniFile(path) for path in paths]
+    for config_list in (configs, configs[:2], [test.IniFile(), test.IniFile()]):
+        matrix = test.ValueMatrix(config_list)
+        if matrix.numpy is None:
+            return 'skipped, NumPy is not installed'
+        expected = sorted(key for key in matrix.keys
+                          if len(set(config.sections.get(key[0], dict()).get(key[1]) for config in config_list)) > 1)
+        for rows in (matrix.diverging_rows(), test.ValueMatrix(config_list, use_numpy=False).diverging_rows()):
+            if [matrix.keys[row] for row in rows] != expected:
+                raise Exception('ValueMatrix has found %d diverging rows instead of %d.' % (len(rows), len(expected)))
+        for row in matrix.diverging_rows():
+            section, option = matrix.keys[row]
+            if matrix.row_values(row) != [config.sections.get(section, dict()).get(option) for config in config_list]:
+                raise Exception('Unexpected values of [%s] %s' % (section, option))
+
+
+SELFTEST_CHECKS = (
+    ('PersistentLdxCmdDriver', check_ldxcmd_driver),
+    ('CompileService', check_compile_service),
+    ('ValueMatrix', check_value_matrix),
+)
+
+
+def selftest():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for name, check in SELFTEST_CHECKS:
+            started = time.time()
+            note = check(os.path.join(temp_dir, name))
+            print('  %-24s %s %8.1f s' % (name, note or 'ok', time.time() - started))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    suite = subparsers.add_parser('suite', help='time the stages of the harness at several scales')
+    suite.add_argument('--scale', help='scale to run (may be given several times, default: all)',
+                       choices=sorted(SCALES), action='append')
+    suite.add_argument('--repeat', help='number of measurements to take the best of (default: %(default)s)',
+                       type=int, default=3)
+    suite.add_argument('--output', help='JSON results file (default: %(default)s)',
+                       type=str, default='bench.json')
+    ini = subparsers.add_parser('ini', help='compare ConfigParser and IniFile INI diff')
+    ini.add_argument('--sections', help='number of sections per INI file (default: %(default)s)',
+                     type=int, default=20)
+    ini.add_argument('--keys', help='number of keys per section (default: %(default)s)',
+                     type=int, default=2000)
+    ini.add_argument('--unequal', help='share of unequal values (default: %(default)s)',
+                     type=float, default=0.01)
+    ini.add_argument('--repeat', help='number of measurements to take the best of (default: %(default)s)',
+                     type=int, default=5)
+    subparsers.add_parser('selftest', help='check the concurrency paths of the harness against the stubs')
+    args = parser.parse_args()
+    if args.command == 'suite':
+        scales = args.scale or sorted(SCALES, key=lambda name: SCALES[name]['projects'])
+        bench_suite(scales, args.repeat, args.output)
+    elif args.command == 'selftest':
+        selftest()
+    else:
+        bench_ini(args.sections, args.keys, args.unequal, args.repeat)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+A stub of the swifttest API module standing in for the real one in tests and benchmarks of the harness.
+Project.compile() copies the 'ini' folder of the project referred to by the AutomationConfig.xml written by
+stubs/LdxCmd to the obj folder, replacing spaces in port folder names with underscores like the API does.
+The compilation of the project named by the SWIFTTEST_CRASH environment variable kills the process, as
+a crash of the native API code would.
+"""
+
+import os
+import shutil
+from xml.dom import minidom
+
+__version__ = 'stub'
+
+
+class Message:
+    def __init__(self, text, source=None):
+        self.text = text
+        self.source = source
+        self.logger = None
+
+
+class Logger:
+    def __init__(self):
+        self.errors = list()
+
+    def error(self, text, source=None):
+        message = Message(text, source)
+        # like the API messages, a message refers back to its logger, which can not be passed between processes
+        message.logger = self
+        self.errors.append(message)
+
+    def each_error(self):
+        return iter(self.errors)
+
+
+class Project:
+    def __init__(self, name, config_xml):
+        self.name = name
+        self.config_xml = config_xml
+
+    def compile(self, obj_dir, force, logger):
+        if self.name == os.environ.get('SWIFTTEST_CRASH'):
+            os._exit(1)
+        try:
+            project_file = minidom.parse(self.config_xml).documentElement.getAttribute('project')
+        except Exception as e:
+            logger.error('Cannot read %s: %s' % (self.config_xml, e))
+            return False
+        ini_dir = os.path.join(os.path.dirname(project_file), 'ini')
+        if not os.path.isdir(ini_dir):
+            logger.error('No ini folder in project: %s' % os.path.dirname(project_file), self.config_xml)
+            return False
+        for port in os.listdir(ini_dir):
+            port_dir = os.path.join(obj_dir, port.replace(' ', '_'))
+            if force and os.path.exists(port_dir):
+                shutil.rmtree(port_dir)
+            shutil.copytree(os.path.join(ini_dir, port), port_dir)
+        return True
@@ -18,21 +18,50 @@ These unequal values fall into 3 categories:
   -- unequal: all the rest of unequal values are marked in red and should be evaluated.
               These may reveal possible mismatch between TDE and API code.
 The ./exceptions folder contains files with their ignored or default values.
+With --db the results are also stored to an SQLite database, "test.py query DB" reports
+the options which were unequal in the recent runs.
+With --shard I/N only a part of the projects is processed, "test.py merge" combines the results
+files of all shards into the results of the whole run.
+"test.py compare PY_OBJ TDE_OBJ" only compares obj folders compiled before, it needs neither
+LdxCmd nor the swifttest module. "test.py matrix TDE_OBJ PY_OBJ..." compares the obj folders
+compiled by many builds of the API against TDE at once.
+With --watch the projects affected by changes of the project tree, the exceptions or the toolchain
+are processed again until the script is interrupted.
 """
 
 from __future__ import print_function
-import swifttest
 import argparse
 import os
 import sys
 import re
-import subprocess
 import shutil
+import signal
+import sqlite3
 import ConfigParser
+import collections
+import contextlib
+import cProfile
+import fnmatch
+import hashlib
+import itertools
+import json
+import operator
+import Queue
+import StringIO
+import threading
+import time
+import traceback
+from xml.sax.saxutils import escape, quoteattr
 
 
-if sys.platform.startswith("win"):
-    import _winreg
+# os.scandir is available since Python 3.5, for older versions try the scandir backport
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 
 #
@@ -41,6 +70,9 @@ if sys.platform.startswith("win"):
 SWIFTTEST_PROJECT_FILE_EXT = ".swift_test"
 WINDOWS_GUID_RX = "\{[0-9A-F]{8}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{12}\}$"
 SWIFTTEST_PROJECT_FILE_RX = '.*\.swift_test$'
+EXCEPTIONS_DIR = 'exceptions'
+BUILD_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'api_test')
+BUILD_CACHE_SIZE_MB = 4096
 PORT_RX = '(Client|Server)_Port_\d+'
 
 
@@ -51,6 +83,15 @@ class Alignment:
     RIGHT = 2
 
 
+def make_dirs(path):
+    """Create the directory with all missing parents unless it exists (possibly created by a concurrent worker)."""
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
 def copyDirectory(src, dest):
     try:
         shutil.copytree(src, dest)
@@ -62,41 +103,90 @@ def copyDirectory(src, dest):
         print('Directory not copied. Error: %s' % e)
 
 
-def is_project(path):
-    for s in os.listdir(path):
-        if not s.startswith('.'):
-            subitem = os.path.join(path, s)
-            if os.path.isfile(subitem):
-                ext = os.path.splitext(s)
-                if ext[1] == SWIFTTEST_PROJECT_FILE_EXT:
-                    return True
+def list_dir(path):
+    """
+    Return a list of (name, is_dir, is_file) items for the directory content sorted by name.
+    The directory is listed only once if os.scandir (or its backport) is available.
+    """
+    if scandir:
+        result = [(e.name, e.is_dir(), e.is_file()) for e in scandir(path)]
+    else:
+        result = list()
+        for name in os.listdir(path):
+            sub_item = os.path.join(path, name)
+            result.append((name, os.path.isdir(sub_item), os.path.isfile(sub_item)))
+    result.sort()
+    return result
+
+
+def is_project(path, entries=None):
+    """Check if the directory contains a TDE project file. 'entries' is the directory content from list_dir()."""
+    if entries is None:
+        entries = list_dir(path)
+    for name, is_dir, is_file in entries:
+        if not name.startswith('.') and is_file:
+            ext = os.path.splitext(name)
+            if ext[1] == SWIFTTEST_PROJECT_FILE_EXT:
+                return True
     return False
 
 
-def dig_tests(path, depth=256):
+def is_excluded(path, exclude):
+    """Check if the directory name or its full path matches any of the glob patterns in 'exclude'."""
+    name = os.path.basename(os.path.normpath(path))
+    for pattern in exclude:
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(path, pattern):
+            return True
+    return False
+
+
+def dig_tests(path, depth=256, exclude=()):
     """
-    Look through the directory tree starting from 'path' to the given 'depth' and return a list of
-    full paths to test projects found. [depth == 1: no search in subfolders; default: search to the depth of 256]
+    Look through the directory tree starting from 'path' to the given 'depth' and yield full paths
+    to test projects as soon as they are found. [depth == 1: no search in subfolders; default: search to the depth
+    of 256]. Subfolders matching any of the glob patterns in 'exclude' are not searched.
     """
     if depth > 256:
         depth = 256
     elif depth < 0:
         depth = 0
-    result = set()
-    if is_project(path):
-        result.add(path)
-    else:
-        if depth > 0:
-            depth -= 1
-            for si in os.listdir(path):
-                sub_item = os.path.join(path, si)
-                if os.path.isdir(sub_item):
-                    result |= (dig_tests(sub_item, depth))
-    return result
+    stack = [(path, depth)]
+    while stack:
+        path, depth = stack.pop()
+        entries = list_dir(path)
+        if is_project(path, entries):
+            yield path
+        elif depth > 0:
+            # push in reverse order to walk the subfolders alphabetically
+            for name, is_dir, is_file in reversed(entries):
+                sub_item = os.path.join(path, name)
+                if is_dir and not is_excluded(sub_item, exclude):
+                    stack.append((sub_item, depth - 1))
+
+
+class DuplicateProject(Exception):
+    """Two test projects found have the same folder name."""
+    pass
+
+
+def unique_projects(path_list):
+    """
+    Yield the projects of 'path_list' raising DuplicateProject on a project named like one yielded before:
+    the AutomationConfig and obj folders, baselines, logs and results of a project are keyed by its folder name.
+    """
+    seen = dict()
+    for project_dir in path_list:
+        project_name = os.path.split(project_dir)[-1]
+        if project_name in seen:
+            raise DuplicateProject('Projects %s and %s have the same name, exclude one of them with --exclude.' %
+                                   (seen[project_name], project_dir))
+        seen[project_name] = project_dir
+        yield project_dir
 
 
 def find_ldxcmd():
     if sys.platform.startswith("win"):
+        import _winreg
         # Read from SOFTWARE\Microsoft\Windows\CurrentVersion\Uninstall
         # Setting security access mode. KEY_WOW64_64KEY is used for 64-bit TDE
         sam = _winreg.KEY_READ | _winreg.KEY_WOW64_64KEY
@@ -142,72 +232,788 @@ def get_files(directory, pattern):
     return [os.path.join(directory, f) for f in os.listdir(directory) if re.match(pattern, f) and not f.startswith('.')]
 
 
-def convert(LDXCMD_BIN, project_dir, config_dir):
-    """Convert TDE project to AutomationConfig."""
+def convert(ldxcmd, project_dir, config_dir, timeout=None, log_path=None):
+    """
+    Convert TDE project to AutomationConfig using the LdxCmdDriver 'ldxcmd'.
+    Raise ToolTimeout if LdxCmd does not complete in 'timeout' seconds, its output is appended to 'log_path'.
+    """
     project_files = get_files(project_dir, SWIFTTEST_PROJECT_FILE_RX)
     if len(project_files) > 1:
         raise Exception('More than one .swift_test file found in dir: %s' % project_dir)
     if len(project_files) == 0:
         raise Exception('No .swift_test file found in dir: %s' % project_dir)
     project_file = project_files[0]
-    # find the path to LdxCmd
     print ('Converting project to AutomationConfig.')
-    p = subprocess.Popen([LDXCMD_BIN,
-                          '--generate', '--project:' + project_file,
-                          '--upgrade',
-                          '--Force',
-                          '--out:' + config_dir], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, err = p.communicate()
-    if p.returncode:
+    returncode, output = ldxcmd.run(['--generate', '--project:' + project_file,
+                                     '--upgrade',
+                                     '--Force',
+                                     '--out:' + config_dir], timeout=timeout, log_path=log_path)
+    if returncode:
         print(output)
         raise Exception('An error occured during conversion.')
 
 
-def generate(config_dir, generate_dir):
+def generate(config_dir, generate_dir, timeout=None, log_path=None):
     project_name = os.path.split(config_dir)[-1]
-    p = subprocess.Popen(['/opt/swifttest/bin/swiftgenerator',
-                          '--name=' + project_name,
-                          '--inpath=\'' + os.path.join(config_dir, 'AutomationConfig.xml\''),
-                          '--outpath=\'' + os.path.join(generate_dir, 'py', project_name) + '\'',
-                          '--python'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, err = p.communicate()
-    if p.returncode:
-        print(output)
+    p = AsyncProcess(['/opt/swifttest/bin/swiftgenerator',
+                      '--name=' + project_name,
+                      '--inpath=\'' + os.path.join(config_dir, 'AutomationConfig.xml\''),
+                      '--outpath=\'' + os.path.join(generate_dir, 'py', project_name) + '\'',
+                      '--python'], timeout=timeout, log_path=log_path)
+    if p.wait():
+        print(p.output)
         raise Exception('An error occured during generation.')
 
 
-def compile (LDXCMD_BIN, config_dir, compile_dir):
-    # compile using python swifttest API
+class ToolTimeout(Exception):
+    """An external tool has not completed in time and has been killed."""
+    pass
+
+
+# number of the last output lines of an external tool kept in memory
+TOOL_OUTPUT_LINES = 1000
+
+_tool_semaphore = None
+
+
+def set_tool_limit(limit):
+    """
+    Limit the number of external tools running at once to 'limit' (0: no limit). The limit is shared
+    with worker processes forked after the call.
+    """
+    global _tool_semaphore
+    _tool_semaphore = None
+    if limit:
+        import multiprocessing
+        _tool_semaphore = multiprocessing.BoundedSemaphore(limit)
+
+
+@contextlib.contextmanager
+def tool_slot():
+    """Wait for a free slot to run an external tool in the 'with' block."""
+    semaphore = _tool_semaphore
+    if semaphore:
+        semaphore.acquire()
+    try:
+        yield
+    finally:
+        if semaphore:
+            semaphore.release()
+
+
+def new_process_group():
+    """Return Popen() arguments starting the process in a new process group, see kill_process_group()."""
+    if sys.platform.startswith("win"):
+        import subprocess
+        return dict(creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+    return dict(preexec_fn=os.setsid)
+
+
+def kill_process_group(process):
+    """Kill the process started with new_process_group() along with all processes it has started."""
+    try:
+        if sys.platform.startswith("win"):
+            import subprocess
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call(['taskkill', '/F', '/T', '/PID', str(process.pid)], stdout=devnull, stderr=devnull)
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+class AsyncProcess:
+    """
+    Run an external command in a background thread, so that the command can run while the caller does
+    other work. The output (stdout and stderr) is read line by line and appended to 'log_path' as it comes,
+    only the last TOOL_OUTPUT_LINES lines are kept in 'output'. If the command does not complete
+    in 'timeout' seconds, its process group is killed and wait() raises ToolTimeout.
+    The command waits for a free slot if the number of running tools is limited with set_tool_limit().
+    """
+    def __init__(self, cmd, timeout=None, log_path=None):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.log_path = log_path
+        self.output = ''
+        self.returncode = None
+        self.timed_out = False
+        self.started = time.time()
+        self.finished = None
+        self.process = None
+        self._cancelled = False
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            with tool_slot():
+                if not self._cancelled:
+                    self._communicate()
+        except Exception as e:
+            self._error = e
+        self.finished = time.time()
+
+    def _communicate(self):
+        import subprocess
+        self.started = time.time()
+        self.process = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        **new_process_group())
+        lines = collections.deque(maxlen=TOOL_OUTPUT_LINES)
+        log = open(self.log_path, 'a') if self.log_path else None
+        watchdog = threading.Timer(self.timeout, self._expire) if self.timeout else None
+        try:
+            if watchdog:
+                watchdog.daemon = True
+                watchdog.start()
+            if log:
+                log.write('$ %s\n' % ' '.join(self.cmd))
+            for line in iter(self.process.stdout.readline, ''):
+                lines.append(line)
+                if log:
+                    log.write(line)
+                    log.flush()
+            self.returncode = self.process.wait()
+        finally:
+            if watchdog:
+                watchdog.cancel()
+            if log:
+                log.close()
+            self.output = ''.join(lines)
+
+    def _expire(self):
+        self.timed_out = True
+        kill_process_group(self.process)
+
+    def wait(self):
+        """Wait for the command to complete and return its exit code."""
+        self._thread.join()
+        if self._error:
+            raise self._error
+        if self.timed_out:
+            raise ToolTimeout('%s has not completed in %s s and has been killed.' % (self.cmd[0], self.timeout))
+        return self.returncode
+
+    def cancel(self):
+        self._cancelled = True
+        if self.process:
+            kill_process_group(self.process)
+
+
+class LdxCmdDriver:
+    """
+    Run LdxCmd commands starting a new LdxCmd process for every command.
+    The LdxCmd executable may be replaced with stubs/LdxCmd to run without TDE installed.
+    """
+    def __init__(self, LDXCMD_BIN):
+        self.LDXCMD_BIN = LDXCMD_BIN
+
+    def start(self, args, timeout=None, log_path=None):
+        """
+        Start LdxCmd with the command line arguments 'args' and return a handle with wait() and cancel().
+        See AsyncProcess for 'timeout' and 'log_path'.
+        """
+        return AsyncProcess([self.LDXCMD_BIN] + args, timeout, log_path)
+
+    def run(self, args, timeout=None, log_path=None):
+        """Run LdxCmd with the command line arguments 'args' and return (returncode, output)."""
+        command = self.start(args, timeout, log_path)
+        returncode = command.wait()
+        return returncode, command.output
+
+    def close(self):
+        pass
+
+
+class PersistentLdxCmdDriver(LdxCmdDriver):
+    """
+    Keep a single LdxCmd process running in --server mode and feed commands to it over stdin, so that
+    mono/.NET startup is paid once per worker instead of once per command. On startup the server writes
+    a {"server": 1} line. Every request is a JSON list of command line arguments on a single line, LdxCmd
+    answers with a single line JSON object {"returncode": ..., "output": ...}. The process runs one command
+    at a time. LdxCmd builds without the --server mode are detected by the missing startup line.
+    """
+    STARTUP_TIMEOUT = 120
+
+    def __init__(self, LDXCMD_BIN):
+        LdxCmdDriver.__init__(self, LDXCMD_BIN)
+        self._process = None
+        self._lock = threading.Lock()
+
+    def _start_server(self):
+        """Start the server process and wait for its startup line."""
+        import subprocess
+        process = subprocess.Popen([self.LDXCMD_BIN, '--server'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, **new_process_group())
+        lines = list()
+        reader = threading.Thread(target=lambda: lines.append(process.stdout.readline()))
+        reader.daemon = True
+        reader.start()
+        reader.join(self.STARTUP_TIMEOUT)
+        try:
+            response = json.loads(lines[0]) if lines else None
+        except ValueError:
+            response = None
+        if not isinstance(response, dict) or response.get('server') != 1:
+            kill_process_group(process)
+            process.wait()
+            raise Exception('This LdxCmd build does not support --server, use --ldxcmd-mode process: %s'
+                            % self.LDXCMD_BIN)
+        return process
+
+    def probe(self):
+        """Check that LdxCmd supports --server by starting and stopping a server process."""
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                self._process = self._start_server()
+        self.close()
+
+    def request(self, args, timeout=None):
+        """
+        Run a command in the LdxCmd server process and return (returncode, output). If the command does not
+        complete in 'timeout' seconds, counted from the moment the server takes it, the server is killed
+        and ToolTimeout is raised.
+        """
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                self._process = self._start_server()
+            process = self._process
+            expired = threading.Event()
+
+            def expire():
+                expired.set()
+                kill_process_group(process)
+            watchdog = threading.Timer(timeout, expire) if timeout else None
+            try:
+                if watchdog:
+                    watchdog.daemon = True
+                    watchdog.start()
+                process.stdin.write(json.dumps(args) + '\n')
+                process.stdin.flush()
+                response = process.stdout.readline()
+            except IOError:
+                response = ''
+            finally:
+                if watchdog:
+                    watchdog.cancel()
+            if not response:
+                self._process = None
+                if expired.is_set():
+                    raise ToolTimeout('LdxCmd server has not completed the command in %s s and has been killed.'
+                                      % timeout)
+                raise Exception('LdxCmd server terminated unexpectedly.')
+            response = json.loads(response)
+            return response['returncode'], response.get('output', '')
+
+    def start(self, args, timeout=None, log_path=None):
+        return LdxCmdRequest(self, args, timeout, log_path)
+
+    def kill(self):
+        """Kill the server process, it is restarted by the next request."""
+        process = self._process
+        if process and process.poll() is None:
+            kill_process_group(process)
+
+    def close(self):
+        with self._lock:
+            if self._process and self._process.poll() is None:
+                self._process.stdin.close()
+                self._process.wait()
+            self._process = None
+
+
+class LdxCmdRequest:
+    """A command of PersistentLdxCmdDriver running in a background thread, see AsyncProcess."""
+    def __init__(self, driver, args, timeout=None, log_path=None):
+        self.output = ''
+        self.returncode = None
+        self.timeout = timeout
+        self.log_path = log_path
+        self.started = time.time()
+        self.finished = None
+        self._driver = driver
+        self._args = args
+        self._error = None
+        self._thread = threading.Thread(target=self._request)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _request(self):
+        try:
+            with tool_slot():
+                self.started = time.time()
+                self.returncode, self.output = self._driver.request(self._args, self.timeout)
+            if self.log_path:
+                with open(self.log_path, 'a') as log:
+                    log.write('$ %s %s\n%s' % (self._driver.LDXCMD_BIN, ' '.join(self._args), self.output))
+        except Exception as e:
+            self._error = e
+        self.finished = time.time()
+
+    def wait(self):
+        """Wait for the command to complete and return its exit code."""
+        self._thread.join()
+        if self._error:
+            raise self._error
+        return self.returncode
+
+    def cancel(self):
+        self._driver.kill()
+
+
+LDXCMD_DRIVERS = {
+    'process': LdxCmdDriver,
+    'persistent': PersistentLdxCmdDriver,
+}
+
+_ldxcmd_drivers = dict()
+
+
+def get_ldxcmd_driver(LDXCMD_BIN, mode='process'):
+    """Return the LdxCmdDriver of the current process for the given mode, creating it on the first call."""
+    # drivers are not shared with forked workers
+    key = (os.getpid(), LDXCMD_BIN, mode)
+    if key not in _ldxcmd_drivers:
+        _ldxcmd_drivers[key] = LDXCMD_DRIVERS[mode](LDXCMD_BIN)
+    return _ldxcmd_drivers[key]
+
+
+def close_ldxcmd_drivers():
+    for key, driver in _ldxcmd_drivers.items():
+        if key[0] == os.getpid():
+            driver.close()
+    _ldxcmd_drivers.clear()
+
+
+API_PROJECT_CACHE_SIZE = 64
+
+_api_projects = collections.OrderedDict()
+
+
+def get_api_project(project_name, config_xml):
+    """
+    Return a swifttest.Project of the AutomationConfig, reusing the one created for the previous compilation
+    of the same config. The config is identified by its path, size and modification time.
+    """
+    import swifttest
+    try:
+        st = os.stat(config_xml)
+        key = (project_name, config_xml, st.st_size, st.st_mtime)
+    except OSError:
+        # let swifttest report the missing config
+        return swifttest.Project(project_name, config_xml)
+    project = _api_projects.pop(key, None)
+    if project is None:
+        project = swifttest.Project(project_name, config_xml)
+    _api_projects[key] = project
+    while len(_api_projects) > API_PROJECT_CACHE_SIZE:
+        _api_projects.popitem(last=False)
+    return project
+
+
+def message_dict(msg):
+    """Return a swifttest log message as a dict of its plain data attributes, 'text' at least."""
+    result = dict((name, value) for name, value in getattr(msg, '__dict__', dict()).items()
+                  if value is None or isinstance(value, (basestring, bool, int, long, float)))
+    result.setdefault('text', getattr(msg, 'text', str(msg)))
+    return result
+
+
+def run_api_compile(project_name, config_xml, obj_dir_api):
+    """
+    Compile AutomationConfig to *.ini files in the current process using python swifttest API.
+    Return a list of message_dict() items of the errors, empty if the compilation has succeeded.
+    """
+    import swifttest
+    make_dirs(obj_dir_api)
+    logger = swifttest.Logger()
+    if get_api_project(project_name, config_xml).compile(obj_dir_api, True, logger):
+        return list()
+    return [message_dict(msg) for msg in logger.each_error() if msg]
+
+
+def compile_worker(jobs):
+    """
+    Main loop of a CompileService worker process. Take (replies, project_name, config_xml, obj_dir) jobs
+    from the 'jobs' queue until None is taken and put the errors of every compilation to its 'replies' queue.
+    """
+    import swifttest
+    # Ctrl+C is handled by the main process which stops the service
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for replies, project_name, config_xml, obj_dir in iter(jobs.get, None):
+        try:
+            errors = run_api_compile(project_name, config_xml, obj_dir)
+        except Exception as e:
+            errors = [dict(text='%s: %s' % (type(e).__name__, e), traceback=traceback.format_exc())]
+        replies.put(errors)
+
+
+class CompileService:
+    """
+    Pre-forked worker processes compiling AutomationConfig with python swifttest API. swifttest is imported
+    once before the workers are started, the workers stay alive for the whole run and reuse swifttest.Project
+    objects. Jobs are taken from a shared queue, so that the service created by the main process is used by
+    the --jobs workers forked after it as well; every process gets its own reply queue from a Manager.
+    Only the process which has started the workers can tell whether they are alive, so it runs a monitor thread
+    setting a shared event as soon as a worker has exited, on which all clients stop waiting for replies.
+    """
+    MONITOR_INTERVAL = 0.5
+
+    def __init__(self, workers):
+        import multiprocessing
+        import swifttest
+        self._owner = os.getpid()
+        self._manager = multiprocessing.Manager()
+        self._jobs = multiprocessing.Queue()
+        self._broken = multiprocessing.Event()
+        self._closed = threading.Event()
+        self._replies = dict()
+        self._lock = threading.Lock()
+        self._workers = list()
+        for n in range(workers):
+            worker = multiprocessing.Process(target=compile_worker, args=(self._jobs, ),
+                                             name='api-compile-%d' % n)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        self._monitor = threading.Thread(target=self._watch_workers, name='api-compile-monitor')
+        self._monitor.daemon = True
+        self._monitor.start()
+
+    def _watch_workers(self):
+        while not self._closed.wait(self.MONITOR_INTERVAL):
+            if not all(worker.is_alive() for worker in self._workers):
+                self._broken.set()
+                return
+
+    def compile(self, project_name, config_xml, obj_dir):
+        """Compile AutomationConfig in a worker and return a list of message_dict() items of the errors."""
+        with self._lock:
+            replies = self._replies.get(os.getpid())
+            if replies is None:
+                replies = self._replies[os.getpid()] = self._manager.Queue()
+            self._jobs.put((replies, project_name, config_xml, obj_dir))
+            while True:
+                try:
+                    return replies.get(timeout=self.MONITOR_INTERVAL)
+                except Queue.Empty:
+                    if self._broken.is_set():
+                        raise Exception('An API compile worker has exited unexpectedly.')
+
+    def close(self):
+        if os.getpid() != self._owner:
+            return
+        self._closed.set()
+        self._monitor.join()
+        for worker in self._workers:
+            self._jobs.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._manager.shutdown()
+
+
+_compile_service = None
+
+
+def start_compile_service(workers):
+    """Start the CompileService used by compile_api(). Worker processes forked after the call share it."""
+    global _compile_service
+    _compile_service = CompileService(workers)
+
+
+def stop_compile_service():
+    global _compile_service
+    if _compile_service:
+        _compile_service.close()
+        _compile_service = None
+
+
+def compile_api(project_name, config_xml, obj_dir_api):
+    """
+    Compile AutomationConfig to *.ini files using python swifttest API, in the CompileService if it has been
+    started or in-process otherwise. Return a list of message_dict() items of the errors.
+    """
+    if _compile_service:
+        errors = _compile_service.compile(project_name, config_xml, obj_dir_api)
+    else:
+        errors = run_api_compile(project_name, config_xml, obj_dir_api)
+    for error in errors:
+        print('An error occurred during compilation: ' + error['text'], file=sys.stderr)
+    return errors
+
+
+def get_port_folder_name(name):
+    """Return the name of a port folder using underscores instead of spaces as the API does."""
+    if re.match('(Client|Server)\sPort\s\d+', name):
+        return name.replace(' ', '_')
+    return name
+
+
+def link_or_copy(src, dest):
+    """Hard-link the file, copy it if that is not possible (e.g. another filesystem)."""
+    if hasattr(os, 'link'):
+        try:
+            os.link(src, dest)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dest)
+
+
+def link_tree(src, dest):
+    """Recreate the directory tree 'src' in 'dest' hard-linking the files."""
+    for root, dirs, files in os.walk(src):
+        dest_root = os.path.normpath(os.path.join(dest, os.path.relpath(root, src)))
+        os.makedirs(dest_root)
+        for f in files:
+            link_or_copy(os.path.join(root, f), os.path.join(dest_root, f))
+
+
+def handoff_obj_tree(src, dest, mode='move'):
+    """
+    Transfer the obj tree 'src' to 'dest' either moving ('move') or hard-linking ('link') its content,
+    port folders are renamed in the same pass. What can not be moved or linked, e.g. because 'src' and
+    'dest' are on different filesystems, is copied.
+    """
+    os.makedirs(dest)
+    for name in os.listdir(src):
+        src_item = os.path.join(src, name)
+        dest_item = os.path.join(dest, get_port_folder_name(name) if os.path.isdir(src_item) else name)
+        if mode == 'move':
+            try:
+                os.rename(src_item, dest_item)
+                continue
+            except OSError:
+                pass
+        if os.path.isdir(src_item):
+            link_tree(src_item, dest_item)
+        else:
+            link_or_copy(src_item, dest_item)
+
+
+def get_obj_dirs(compile_dir, project_name):
+    """Return the paths to py and tde obj folders of the project."""
+    return (os.path.join(compile_dir, 'py', 'obj', project_name),
+            os.path.join(compile_dir, 'tde', 'obj', project_name))
+
+
+def compile (ldxcmd, config_dir, compile_dir, overlap=False, handoff='copy', timeout=None, log_path=None):
+    """
+    Compile AutomationConfig using python swifttest API and the LdxCmdDriver 'ldxcmd'
+    and return the paths to both obj folders along with the compile_api() errors.
+    With 'overlap' LdxCmd is started before the API compilation, so that both compilers run concurrently.
+    'handoff' is the way the obj tree compiled by LdxCmd is transferred to the tde folder: 'copy', 'move' or 'link'.
+    Raise ToolTimeout if LdxCmd does not complete in 'timeout' seconds, its output is appended to 'log_path'.
+    """
     project_name = os.path.split(config_dir)[-1]
-    obj_dir_api = os.path.join(compile_dir, 'py', 'obj', project_name)
-    if not os.path.exists(obj_dir_api):
-        os.makedirs(obj_dir_api)
+    obj_dir_api, obj_dir_tde = get_obj_dirs(compile_dir, project_name)
     config_xml = os.path.join(config_dir, 'AutomationConfig.xml')
-    project = swifttest.Project(project_name, config_xml)
-    logger = swifttest.Logger()
-    if not project.compile(obj_dir_api, True, logger):
-        for msg in logger.each_error():
-            if msg:
-                print('An error occurred during compilation: ' + msg.text, file=sys.stderr)
+    ldxcmd_args = ['--compile', '--config:' + config_xml]
+    command = None
+    if overlap:
+        command = ldxcmd.start(ldxcmd_args, timeout, log_path)
+
+    # compile using python swifttest API
+    try:
+        with TRACER.stage('compile api', project=project_name):
+            api_errors = compile_api(project_name, config_xml, obj_dir_api)
+    except BaseException:
+        if command:
+            command.cancel()
+        raise
 
     # compile using LdxCmd
-    obj_dir_tde = os.path.join(compile_dir, 'tde', 'obj', project_name)
-    p = subprocess.Popen([LDXCMD_BIN, '--compile', '--config:' + config_xml],
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, err = p.communicate()
-    if p.returncode:
-        print(output)
+    if not command:
+        command = ldxcmd.start(ldxcmd_args, timeout, log_path)
+    returncode = command.wait()
+    TRACER.event('compile ldxcmd', command.started, command.finished - command.started, cat='subprocess',
+                 project=project_name)
+    if returncode:
+        print(command.output)
         raise Exception('An error occurred during compilation.')
     else:
-        if os.path.exists(obj_dir_tde):
-            shutil.rmtree(obj_dir_tde)
-        copyDirectory(os.path.join(config_dir, 'Automation', 'obj'), obj_dir_tde)
-        # rename port folders using underscores instead of spaces
-        for f in os.listdir(obj_dir_tde):
-            if os.path.isdir(os.path.join(obj_dir_tde, f)) and re.match('(Client|Server)\sPort\s\d+', f):
-                new_f = f.replace(' ', '_')
-                os.rename(os.path.join(obj_dir_tde, f), os.path.join(obj_dir_tde, new_f))
-    return obj_dir_api, obj_dir_tde
+        with TRACER.stage('copy obj', project=project_name, mode=handoff):
+            if os.path.exists(obj_dir_tde):
+                shutil.rmtree(obj_dir_tde)
+            if handoff == 'copy':
+                copyDirectory(os.path.join(config_dir, 'Automation', 'obj'), obj_dir_tde)
+                # rename port folders using underscores instead of spaces
+                for f in os.listdir(obj_dir_tde):
+                    if os.path.isdir(os.path.join(obj_dir_tde, f)):
+                        os.rename(os.path.join(obj_dir_tde, f), os.path.join(obj_dir_tde, get_port_folder_name(f)))
+            else:
+                handoff_obj_tree(os.path.join(config_dir, 'Automation', 'obj'), obj_dir_tde, handoff)
+    return obj_dir_api, obj_dir_tde, api_errors
+
+
+def toolchain_id(LDXCMD_BIN):
+    """Return a string identifying the installed LdxCmd and swifttest builds."""
+    import swifttest
+    ids = [str(getattr(swifttest, '__version__', ''))]
+    for path in (LDXCMD_BIN, swifttest.__file__):
+        st = os.stat(path)
+        ids.append('%s:%d:%d' % (path, st.st_size, int(st.st_mtime)))
+    return '\n'.join(ids)
+
+
+class BuildCache:
+    """
+    On-disk cache of converted and compiled projects. Every entry holds the AutomationConfig and
+    py/tde obj trees of a project and is keyed by a hash of the project folder and the toolchain identity.
+    The cache is kept under 'max_size' bytes by evicting the least recently used entries.
+    """
+    SIZE_FILE = '.size'
+
+    def __init__(self, cache_dir, max_size, toolchain):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.toolchain = toolchain
+        make_dirs(cache_dir)
+
+    def key(self, project_dir):
+        """Return the cache key of the project: a hash of all its non-hidden files and the toolchain identity."""
+        h = hashlib.sha1(self.toolchain)
+        for root, dirs, files in os.walk(project_dir):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for f in sorted(files):
+                if f.startswith('.'):
+                    continue
+                path = os.path.join(root, f)
+                h.update('\0' + os.path.relpath(path, project_dir) + '\0')
+                with open(path, 'rb') as fp:
+                    for chunk in iter(lambda: fp.read(1 << 16), ''):
+                        h.update(chunk)
+        return h.hexdigest()
+
+    def restore(self, key, targets):
+        """
+        Copy the cached trees of the entry 'key' to 'targets', a list of (name, path) items.
+        Return False on a cache miss.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry):
+            return False
+        try:
+            # mark the entry as recently used
+            os.utime(entry, None)
+            for name, path in targets:
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+                shutil.copytree(os.path.join(entry, name), path)
+        except (OSError, shutil.Error) as e:
+            # the entry has been evicted or damaged in the middle of the restore
+            print('Build cache entry not restored. Error: %s' % e, file=sys.stderr)
+            return False
+        return True
+
+    def store(self, key, targets):
+        """Copy the trees listed in 'targets', a list of (name, path) items, to the entry 'key' and evict old entries."""
+        entry = os.path.join(self.cache_dir, key)
+        tmp_entry = '%s.%d.tmp' % (entry, os.getpid())
+        try:
+            for name, path in targets:
+                shutil.copytree(path, os.path.join(tmp_entry, name))
+            with open(os.path.join(tmp_entry, self.SIZE_FILE), 'w') as fp:
+                fp.write(str(get_tree_size(tmp_entry)))
+            os.rename(tmp_entry, entry)
+        except (OSError, shutil.Error) as e:
+            # most probably the entry has just been stored by a concurrent worker
+            if not os.path.isdir(entry):
+                print('Build cache entry not stored. Error: %s' % e, file=sys.stderr)
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_size."""
+        entries = list()
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            try:
+                with open(os.path.join(entry, self.SIZE_FILE)) as fp:
+                    size = int(fp.read())
+                entries.append((os.stat(entry).st_mtime, size, entry))
+            except (IOError, OSError, ValueError):
+                continue
+            total += size
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def get_tree_size(path):
+    """Return the total size of all files in the directory tree."""
+    return sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(path) for f in files)
+
+
+class Workspace:
+    """
+    Scratch folder the projects are converted and compiled in, e.g. on a tmpfs. Every project gets
+    AutomationConfig/<project>, py/obj/<project> and tde/obj/<project> folders there, which are removed
+    after the check unless the project failed or 'keep' is set. With 'max_size' (bytes) a new project
+    waits while the scratch space taken by the projects of the run exceeds it and other projects
+    are still running. The counters are shared with worker processes forked after the construction.
+    """
+    def __init__(self, root, max_size=0, keep=False):
+        self.root = os.path.abspath(root)
+        self.max_size = max_size
+        self.keep = keep
+        self._sizes = dict()
+        self._condition = None
+        if max_size:
+            import multiprocessing
+            self._condition = multiprocessing.Condition()
+            self._used = multiprocessing.Value('l', 0, lock=False)
+            self._active = multiprocessing.Value('i', 0, lock=False)
+
+    def project_dirs(self, project_name):
+        """Return the AutomationConfig folder and the py and tde obj folders of the project."""
+        return (os.path.join(self.root, 'AutomationConfig', project_name), ) + get_obj_dirs(self.root, project_name)
+
+    def acquire(self):
+        """Wait for scratch space for a new project."""
+        if not self._condition:
+            return
+        with self._condition:
+            while self._used.value >= self.max_size and self._active.value:
+                self._condition.wait()
+            self._active.value += 1
+
+    def add(self, project_name):
+        """Account for the scratch space taken by the compiled project."""
+        if not self._condition:
+            return
+        size = sum(get_tree_size(path) for path in self.project_dirs(project_name))
+        with self._condition:
+            self._used.value += size - self._sizes.get(project_name, 0)
+        self._sizes[project_name] = size
+
+    def release(self, project_name, failed):
+        """Remove the folders of a project unless it failed or the workspace keeps them."""
+        freed = 0
+        if not failed and not self.keep:
+            for path in self.project_dirs(project_name):
+                shutil.rmtree(path, ignore_errors=True)
+            freed = self._sizes.pop(project_name, 0)
+        if self._condition:
+            with self._condition:
+                self._used.value -= freed
+                self._active.value -= 1
+                self._condition.notify_all()
+
+
+_workspace = None
+
+
+def get_workspace(args):
+    """Return the Workspace of args.scratch, creating it on the first call or if args.scratch has changed."""
+    global _workspace
+    if _workspace is None or _workspace.root != os.path.abspath(args.scratch):
+        _workspace = Workspace(args.scratch, args.scratch_size * 1024 * 1024, args.keep)
+    return _workspace
 
 
 Colors = dict({
@@ -341,104 +1147,778 @@ class Table:
             print('< nothing to output >')
 
 
-def compare_ini(ini_dirs, ini_name):
+class IniFile:
+    """
+    Compact single-pass INI reader. The file is parsed following the syntax of ConfigParser.RawConfigParser
+    into a {section: {option: value}} dict of plain strings. Options are matched case-insensitively
+    as in ConfigParser, but the original spelling of option names is kept in 'names' for output.
+    """
+    SECTION_RX = re.compile(r'\[([^]]+)\]')
+
+    def __init__(self, path=None):
+        self.sections = dict()
+        self.names = dict()
+        if path:
+            self.read(path)
+
+    def read(self, path):
+        """Read an INI file. Missing files are ignored like in ConfigParser.read()."""
+        try:
+            fp = open(path)
+        except IOError:
+            return
+        with fp:
+            self._read(fp, path)
+
+    def _read(self, fp, path):
+        defaults = dict()
+        sections = self.sections
+        names = self.names
+        cursect = None
+        optname = None
+        for lineno, line in enumerate(fp, 1):
+            # comment or blank line
+            if not line.strip() or line[0] in '#;':
+                continue
+            if line[0] in 'rR' and line.split(None, 1)[0].lower() == 'rem':
+                continue
+            # continuation line
+            if line[0].isspace() and cursect is not None and optname:
+                value = line.strip()
+                if value:
+                    cursect[optname] += '\n' + value
+                continue
+            match = self.SECTION_RX.match(line)
+            if match:
+                section = match.group(1)
+                if section == 'DEFAULT':
+                    cursect = defaults
+                else:
+                    cursect = sections.setdefault(section, dict())
+                optname = None
+                continue
+            if cursect is None:
+                raise ConfigParser.MissingSectionHeaderError(path, lineno, line)
+            # option line: the first ':' or '=' delimits the name
+            pos = line.find('=')
+            colon = line.find(':')
+            if colon != -1 and (pos == -1 or colon < pos):
+                pos = colon
+            name = line[:pos].rstrip() if pos > 0 else ''
+            if not name or line[0].isspace():
+                raise ConfigParser.ParsingError(path)
+            value = line[pos + 1:].rstrip('\n').lstrip()
+            # an inline comment follows whitespace, for a value starting with ';' ConfigParser checks
+            # its last character instead
+            comment = value.find(';')
+            if comment != -1 and value[comment - 1].isspace():
+                value = value[:comment]
+            value = value.strip()
+            if value == '""':
+                value = ''
+            optname = name.lower()
+            if optname != name:
+                names[optname] = name
+            cursect[optname] = value
+        # options of the DEFAULT section are inherited by all sections
+        if defaults:
+            for section, options in sections.items():
+                merged = dict(defaults)
+                merged.update(options)
+                sections[section] = merged
+
+    def option_name(self, option):
+        """Return the option name as spelled in the file."""
+        return self.names.get(option, option)
+
+
+def diff_ini(configs):
+    """
+    Merge the sections of IniFile objects in 'configs' in sorted order and yield (section, presence, options)
+    for every section which is not the same in all of them: 'presence' is a list of bools and 'options'
+    is a sorted list of (option, values) items for unequal options, where values[n] is the value in configs[n]
+    or None. Equal options are filtered out by set operations on the dicts without visiting them one by one.
+    """
+    all_sections = set()
+    for conf in configs:
+        all_sections.update(conf.sections)
+    for section in sorted(all_sections):
+        section_options = [conf.sections.get(section) for conf in configs]
+        presence = [options is not None for options in section_options]
+        section_options = [options or dict() for options in section_options]
+        reference = section_options[0].viewitems()
+        unequal = set()
+        for options in section_options[1:]:
+            unequal.update(option for option, value in reference ^ options.viewitems())
+        option_values = [(option, [options.get(option) for options in section_options])
+                         for option in sorted(unequal)]
+        if option_values or not all(presence):
+            yield section, presence, option_values
+
+
+class ReportSink:
+    """
+    Base class of the outputs compare_ini() reports to. Sections and options are passed to the sink
+    as soon as they are found. start() and finish() are called once per run by the main process,
+    the rest of the methods may be called by worker processes.
+    """
+    def start(self):
+        pass
+
+    def begin_file(self, ini_dirs, ini_name, folder_names):
+        pass
+
+    def section(self, section, presence):
+        pass
+
+    def option(self, section, option, values, status):
+        """Report an unequal option. 'values' lists the value in every config or None if absent."""
+        pass
+
+    def end_file(self, ignored_cnt, default_cnt, unequal_cnt):
+        pass
+
+    def unchanged(self, ini_dirs, ini_name, unequal_cnt, report):
+        """
+        Report an INI file skipped since its comparison result is known from the baseline. 'report' lists
+        the [method, args] calls made to the sink when the file was compared, see RecordingSink;
+        they are replayed by default.
+        """
+        for method, args in report:
+            if method == 'begin_file':
+                args = [ini_dirs, ini_name] + args
+            getattr(self, method)(*args)
+
+    def flush(self):
+        """
+        Called by check() after all INI files of a project have been reported and by the workers
+        of the check() pool after every INI file they have reported.
+        """
+        pass
+
+    def finish(self):
+        pass
+
+
+class MultiSink(ReportSink):
+    """Report to several sinks at once."""
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def start(self):
+        for sink in self.sinks:
+            sink.start()
+
+    def begin_file(self, ini_dirs, ini_name, folder_names):
+        for sink in self.sinks:
+            sink.begin_file(ini_dirs, ini_name, folder_names)
+
+    def section(self, section, presence):
+        for sink in self.sinks:
+            sink.section(section, presence)
+
+    def option(self, section, option, values, status):
+        for sink in self.sinks:
+            sink.option(section, option, values, status)
+
+    def end_file(self, ignored_cnt, default_cnt, unequal_cnt):
+        for sink in self.sinks:
+            sink.end_file(ignored_cnt, default_cnt, unequal_cnt)
+
+    def unchanged(self, ini_dirs, ini_name, unequal_cnt, report):
+        for sink in self.sinks:
+            sink.unchanged(ini_dirs, ini_name, unequal_cnt, report)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def finish(self):
+        for sink in self.sinks:
+            sink.finish()
+
+
+class RecordingSink(ReportSink):
+    """
+    Pass the reports of an INI file on to 'sink' and keep them in 'report' as [method, args] items
+    for the baseline, so that ReportSink.unchanged() can replay them. The INI folders and name are left out.
+    """
+    def __init__(self, sink):
+        self.sink = sink
+        self.report = list()
+
+    def begin_file(self, ini_dirs, ini_name, folder_names):
+        self.report.append(['begin_file', [folder_names]])
+        self.sink.begin_file(ini_dirs, ini_name, folder_names)
+
+    def section(self, section, presence):
+        self.report.append(['section', [section, presence]])
+        self.sink.section(section, presence)
+
+    def option(self, section, option, values, status):
+        self.report.append(['option', [section, option, values, status]])
+        self.sink.option(section, option, values, status)
+
+    def end_file(self, ignored_cnt, default_cnt, unequal_cnt):
+        self.report.append(['end_file', [ignored_cnt, default_cnt, unequal_cnt]])
+        self.sink.end_file(ignored_cnt, default_cnt, unequal_cnt)
+
+
+class TableSink(ReportSink):
+    """Output a colored table per INI file."""
+    def __init__(self):
+        self.table = None
+
+    def begin_file(self, ini_dirs, ini_name, folder_names):
+        self.table = Table(ini_name)
+        self.table.add_header([''] + folder_names + ['status'])
+
+    def section(self, section, presence):
+        self.table.add_row(Row([section] + ['+' if present else '-' for present in presence],
+                               align=Alignment.CENTER))
+
+    def option(self, section, option, values, status):
+        color = {'unequal': 'Red', 'ignore': 'Grey', 'default': 'Blue'}.get(status, 'Default')
+        data = ['  ' + option] + ['-' if value is None else value for value in values] + [status]
+        self.table.add_row(Row(data, font=color))
+
+    def end_file(self, ignored_cnt, default_cnt, unequal_cnt):
+        self.table.add_sep()
+        if ignored_cnt or default_cnt or unequal_cnt:
+            self.table.add_total('Ignored:', ignored_cnt)
+            self.table.add_total('Default:', default_cnt)
+            self.table.add_total('Unequal:', unequal_cnt)
+        self.table.output()
+        self.table = None
+
+    def unchanged(self, ini_dirs, ini_name, unequal_cnt, report):
+        print(ini_name + ': unchanged' + (', unequal: %d' % unequal_cnt if unequal_cnt else ''))
+
+
+class AppendFile:
+    """
+    A file shared by worker processes. Every write() is a single write to a descriptor opened
+    in append mode, so that the data written by concurrent workers does not interleave.
+    close() closes the descriptor of the current process, the next write() opens it again.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._pid = None
+
+    def write(self, data):
+        # every worker process opens the file on its own
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        os.write(self._fd, data)
+
+    def close(self):
+        if self._pid == os.getpid():
+            os.close(self._fd)
+        self._fd = None
+        self._pid = None
+
+
+class LocationSink(ReportSink):
+    """Base class of sinks recording the project, port and INI file name of the options reported."""
+    def __init__(self):
+        self.project = ''
+        self.port = ''
+        self.ini_name = ''
+        self.folder_names = list()
+
+    def begin_file(self, ini_dirs, ini_name, folder_names):
+        # ini_dirs are <build>/obj/<project>/<port> folders
+        self.project, self.port = os.path.split(os.path.normpath(sorted(ini_dirs)[0]))
+        self.project = os.path.basename(self.project)
+        self.ini_name = ini_name
+        self.folder_names = folder_names
+
+
+class FileSink(LocationSink):
+    """Base class of sinks streaming records to an AppendFile."""
+    def __init__(self, path):
+        LocationSink.__init__(self)
+        self.path = path
+        self._file = AppendFile(path)
+
+    def write(self, data):
+        self._file.write(data)
+
+    def start(self):
+        open(self.path, 'w').close()
+
+    def end_file(self, ignored_cnt, default_cnt, unequal_cnt):
+        # a sink is created per project, the descriptor must not outlive the INI file
+        self._file.close()
+
+    def flush(self):
+        self._file.close()
+
+    def finish(self):
+        self._file.close()
+
+
+class JsonLinesSink(FileSink):
+    """Write a JSON object per unequal, ignored or default option."""
+    def option(self, section, option, values, status):
+        record = dict(project=self.project, port=self.port, ini=self.ini_name, section=section, option=option,
+                      values=dict(zip(self.folder_names, values)), status=status)
+        self.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+class JUnitSink(FileSink):
+    """
+    Write a JUnit XML test suite with a test case per unequal, ignored or default option.
+    Unequal options are reported as failures, ignored and default ones as skipped.
+    """
+    def start(self):
+        FileSink.start(self)
+        self.write('<?xml version="1.0" encoding="UTF-8"?>\n<testsuite name="api_test">\n')
+
+    def option(self, section, option, values, status):
+        values = ', '.join('%s=%s' % (name, '-' if value is None else value)
+                           for name, value in zip(self.folder_names, values))
+        if status == 'unequal':
+            result = '<failure message=%s>%s</failure>' % (quoteattr(status), escape(values))
+        else:
+            result = '<skipped message=%s/>' % quoteattr('%s: %s' % (status, values))
+        self.write('  <testcase classname=%s name=%s>%s</testcase>\n' % (
+            quoteattr('.'.join((self.project, self.port, self.ini_name))),
+            quoteattr('[%s] %s' % (section, option)), result))
+
+    def finish(self):
+        self.write('</testsuite>\n')
+        FileSink.finish(self)
+
+
+REPORT_SINKS = {
+    'table': TableSink,
+    'jsonl': JsonLinesSink,
+    'junit': JUnitSink,
+}
+
+
+class ResultsDb:
+    """
+    SQLite store of the comparison results of all runs: a row per unequal, ignored or default option
+    with the values in every obj folder as a JSON object, and a row per project compared at the run.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            started TEXT,
+            test_path TEXT);
+        CREATE TABLE IF NOT EXISTS run_projects (
+            run_id INTEGER,
+            project TEXT,
+            files_failed TEXT);
+        CREATE TABLE IF NOT EXISTS results (
+            run_id INTEGER,
+            project TEXT,
+            port TEXT,
+            ini TEXT,
+            section TEXT,
+            option TEXT,
+            status TEXT,
+            ini_values TEXT);
+        CREATE INDEX IF NOT EXISTS results_option ON results (project, port, ini, section, option);
+        CREATE INDEX IF NOT EXISTS results_run ON results (run_id, status);
+        CREATE INDEX IF NOT EXISTS run_projects_run ON run_projects (run_id, project);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # concurrent workers wait for each other's transactions
+        self.conn = sqlite3.connect(path, timeout=600)
+        self.conn.executescript(self.SCHEMA)
+
+    def add_run(self, test_path):
+        """Register a new run and return its id."""
+        with self.conn:
+            cursor = self.conn.execute('INSERT INTO runs (started, test_path) VALUES (?, ?)',
+                                       (time.strftime('%Y-%m-%d %H:%M:%S'), test_path))
+        return cursor.lastrowid
+
+    def add_project(self, run_id, project, files_failed):
+        with self.conn:
+            self.conn.execute('INSERT INTO run_projects VALUES (?, ?, ?)', (run_id, project, str(files_failed)))
+
+    def add_results(self, rows):
+        """Insert (run_id, project, port, ini, section, option, status, ini_values) rows in a single transaction."""
+        with self.conn:
+            self.conn.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def close(self):
+        self.conn.close()
+
+
+class SqliteSink(LocationSink):
+    """
+    Store every unequal, ignored or default option in the ResultsDb. The rows are inserted
+    in batches of BATCH_SIZE rows, each in a single transaction.
+    """
+    BATCH_SIZE = 5000
+
+    def __init__(self, path, run_id):
+        LocationSink.__init__(self)
+        self.path = path
+        self.run_id = run_id
+        self.rows = list()
+        self._db = None
+        self._pid = None
+
+    def option(self, section, option, values, status):
+        self.rows.append((self.run_id, self.project, self.port, self.ini_name, section, option, status,
+                          json.dumps(dict(zip(self.folder_names, values)), sort_keys=True)))
+        if len(self.rows) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        # sqlite connections can not be shared with forked workers
+        if self._pid != os.getpid():
+            self._db = ResultsDb(self.path)
+            self._pid = os.getpid()
+        self._db.add_results(self.rows)
+        self.rows = list()
+
+    def finish(self):
+        self.flush()
+
+
+def get_report_sink(args):
+    """Return the report sink selected by --format and --output, also storing the results to --db if given."""
+    if args.format == 'table':
+        sink = TableSink()
+    else:
+        sink = REPORT_SINKS[args.format](args.output or 'report.' + ('xml' if args.format == 'junit' else 'jsonl'))
+    if args.db:
+        sink = MultiSink([sink, SqliteSink(args.db, args.run_id)])
+    return sink
+
+
+class ExceptionRules:
+    """
+    In-memory index of the ignored and default values listed in the exceptions folder.
+    Every *.ini file there holds the exceptions for INI files of the same name with digits stripped
+    (e.g. Port.ini for Port1.ini). Section and option names are looked up with leading and trailing digits
+    stripped and option names lowercased, the rules are stored as written, so they are written in that form
+    and may be glob patterns (e.g. 'fc*=default'). Exact rules are looked up in a dict and take precedence
+    over patterns, which are compiled into a single regex per section; results are memoized.
+    """
+    def __init__(self, exceptions_dir=EXCEPTIONS_DIR):
+        self._exact = dict()
+        self._patterns = dict()
+        self._cache = dict()
+        self._rules = list()
+        if os.path.isdir(exceptions_dir):
+            for file_name in sorted(os.listdir(exceptions_dir)):
+                if file_name.endswith('.ini') and not file_name.startswith('.'):
+                    self.add_file(file_name, IniFile(os.path.join(exceptions_dir, file_name)))
+
+    @staticmethod
+    def is_pattern(name):
+        return any(c in name for c in '*?[')
+
+    def add_file(self, file_name, ini):
+        """Add rules from the exceptions IniFile 'ini' applied to INI files named 'file_name'."""
+        self._cache.clear()
+        patterns = self._patterns.setdefault(file_name, list())
+        for section in sorted(ini.sections):
+            options = ini.sections[section]
+            option_patterns = list()
+            for option in sorted(options):
+                self._rules.append((file_name, section, option, options[option]))
+                if self.is_pattern(option) or self.is_pattern(section):
+                    option_patterns.append((option, options[option]))
+                else:
+                    self._exact[(file_name, section, option)] = options[option]
+            if option_patterns:
+                section_rx = re.compile(fnmatch.translate(section))
+                option_rx = re.compile('|'.join('(?P<r%d>%s)' % (n, fnmatch.translate(option))
+                                                for n, (option, status) in enumerate(option_patterns)))
+                statuses = dict(('r%d' % n, status) for n, (option, status) in enumerate(option_patterns))
+                patterns.append((section_rx, option_rx, statuses))
+
+    @property
+    def digest(self):
+        """A digest of all rules, changed whenever the exceptions are."""
+        return hashlib.sha1(repr(sorted(self._rules))).hexdigest()
+
+    def get(self, ini_name, section, option):
+        """Return the status ('ignore', 'default' or 'unequal') of the option of the INI file."""
+        key = (ini_name, section, option)
+        status = self._cache.get(key)
+        if status is None:
+            file_name, file_ext = os.path.splitext(ini_name)
+            file_name = file_name.strip('1234567890') + file_ext
+            section = section.strip('1234567890')
+            option = option.lower().strip('1234567890')
+            status = self._exact.get((file_name, section, option))
+            if status is None:
+                for section_rx, option_rx, statuses in self._patterns.get(file_name, ()):
+                    if section_rx.match(section):
+                        match = option_rx.match(option)
+                        if match:
+                            status = statuses[match.lastgroup]
+                            break
+            if status is None:
+                status = 'unequal'
+            self._cache[key] = status
+        return status
+
+
+_exception_rules = None
+
+
+def get_exception_rules(reload=False):
+    """Return the ExceptionRules of the exceptions folder, loading them on the first call or with 'reload'."""
+    global _exception_rules
+    if _exception_rules is None or reload:
+        _exception_rules = ExceptionRules()
+    return _exception_rules
+
+
+def get_folder_names(ini_dirs):
+    """Return a {ini_dir: folder_name} dict of short identifiers of the folders (e.g. 'py' and 'tde')."""
+    common_prefix_len = len(os.path.commonprefix(list(ini_dirs)))
+    # extract the first unique item of the path to use as an identifier of ini files set
+    return dict((ini_dir, ini_dir[common_prefix_len:].split(os.sep)[0]) for ini_dir in ini_dirs)
+
+
+def compare_ini(ini_dirs, ini_name, sink=None, inis=None):
+    """
+    Compare the INI files named 'ini_name' in all 'ini_dirs', report the differences to 'sink'
+    and return the number of unequal options. 'inis' may hold already parsed {ini_dir: IniFile} items.
+    """
     # list of configuration INI readers
     configs = list()
-    common_prefix_len = len(os.path.commonprefix(ini_dirs))
-    # iterate all ini files and make a list of (folder_name, ConfigParser) items
+    folder_names = get_folder_names(ini_dirs)
+    # iterate all ini files and make a list of (folder_name, IniFile) items
     for ini_dir in ini_dirs:
-        # extract the first unique item of the path to use as an identifier of ini files set
-        folder_name = ini_dir[common_prefix_len:].split(os.sep)[0]
-        configs.append((folder_name, ConfigParser.RawConfigParser()))
-        configs[-1][1].read(os.path.join(ini_dir, ini_name))
-
-    # initialize exceptions from the corresponding exceptions *.ini
-    exceptions = ConfigParser.RawConfigParser()
-    file_name, file_ext = os.path.splitext(ini_name)
-    exception_ini = file_name.strip('1234567890') + file_ext
-    exception_ini = os.path.join('exceptions', exception_ini)
-    if os.path.exists(exception_ini):
-        exceptions.read(exception_ini)
-
-    # build a united structure of all sections in all configs
-    conf_structure = dict()
-    result_table = Table(ini_name)
-    header = list()
-    header.append('')
-    for folder_name, conf in configs:
-        # compose the header of the result table
-        header.append(folder_name)
-        for section in conf.sections():
-            if not conf_structure.has_key(section):
-                conf_structure[section] = set()
-            conf_structure[section] |= set(conf.options(section))
-    header.append('status')
-    result_table.add_header(header)
+        if inis and ini_dir in inis:
+            configs.append((folder_names[ini_dir], inis[ini_dir]))
+        else:
+            configs.append((folder_names[ini_dir], IniFile(os.path.join(ini_dir, ini_name))))
+
+    exceptions = get_exception_rules()
+
+    if sink is None:
+        sink = TableSink()
+    sink.begin_file(ini_dirs, ini_name, [folder_name for folder_name, conf in configs])
     # initializing statistic counters
     ignored_cnt = 0
     default_cnt = 0
     unequal_cnt = 0
-    for section in conf_structure:
-        section_exc = section.strip('1234567890')
-        section_values = list()
+    for section, presence, unequal_options in diff_ini([conf for folder_name, conf in configs]):
         option_values = list()
-        section_values.append(section)
-        for folder_name, conf in configs:
-            if conf.has_section(section):
-                section_values.append('+')
-            else:
-                section_values.append('-')
-        for option in conf_structure[section]:
-            option_exc = option.strip('1234567890')
-            value_exc = 'unequal'
-            # if current option is marked 'ignore' in exceptions list - don't check it
-            if exceptions.has_section(section_exc):
-                if exceptions.has_option(section_exc, option_exc):
-                    value_exc = exceptions.get(section_exc, option_exc)
-            values = list()
-            values.append('  ' + str(option))
-            for folder_name, conf in configs:
-                if conf.has_section(section):
-                    if conf.has_option(section, option):
-                        values.append(conf.get(section, option))
-                    else:
-                        values.append('-')
-                else:
-                    values.append('-')
-            # if at least 2 different values are found - add a row to the table
-            if len(set(values)) > 2:
-                values.append(value_exc)
-                option_values.append(values)
-            # else:
-            #     equal_cnt += 1
-        # add to output: name of the section and its state (present/absent) for each conf
-        if len(set(section_values)) > 2 or len(option_values):
-            result_table.add_row(Row(section_values, align=Alignment.CENTER))
-            for ov in option_values:
-                value_exc = ov[-1]
-                color = 'Default'
+        for option, conf_values in unequal_options:
+            # if at least 2 different values are found - report the option
+            if len(set('-' if value is None else value for value in conf_values)) > 1:
+                option_name = next(conf.option_name(option) for (folder_name, conf), value
+                                   in zip(configs, conf_values) if value is not None)
+                # if current option is marked 'ignore' in exceptions list - don't check it
+                option_values.append((option_name, conf_values, exceptions.get(ini_name, section, option)))
+        # report the section and its state (present/absent) for each conf followed by its unequal options
+        if not all(presence) or len(option_values):
+            sink.section(section, presence)
+            for option_name, conf_values, value_exc in option_values:
                 if value_exc == 'unequal':
-                    color = 'Red'
                     unequal_cnt += 1
-                else:
-                    if value_exc == 'ignore':
-                        color = 'Grey'
-                        ignored_cnt += 1
-                    else:
-                        if value_exc == 'default':
-                            color = 'Blue'
-                            default_cnt += 1
-                result_table.add_row(Row(ov, font=color))
-    result_table.add_sep()
-    if ignored_cnt or default_cnt or unequal_cnt:
-        result_table.add_total('Ignored:', ignored_cnt)
-        result_table.add_total('Default:', default_cnt)
-        result_table.add_total('Unequal:', unequal_cnt)
-    result_table.output()
-    return bool(unequal_cnt)
+                elif value_exc == 'ignore':
+                    ignored_cnt += 1
+                elif value_exc == 'default':
+                    default_cnt += 1
+                sink.option(section, option_name, conf_values, value_exc)
+    sink.end_file(ignored_cnt, default_cnt, unequal_cnt)
+    return unequal_cnt
 
 
-def check(obj_dirs):
+class ValueMatrix:
+    """
+    The options of an INI file in several builds as a matrix of interned values: a row per (section, option),
+    a column per build. Values are interned to integer ids, 0 standing for an absent option, so that the
+    builds are compared by whole columns at once: as NumPy arrays if NumPy is installed, as lists otherwise.
+    """
+    def __init__(self, configs, use_numpy=True):
+        self.keys = list()
+        self.values = [None]
+        row_ids = dict()
+        value_ids = {None: 0}
+        columns = list()
+        for conf in configs:
+            column = dict()
+            for section, options in conf.sections.iteritems():
+                for option, value in options.iteritems():
+                    row = row_ids.get((section, option))
+                    if row is None:
+                        row = row_ids[(section, option)] = len(self.keys)
+                        self.keys.append((section, option))
+                    value_id = value_ids.get(value)
+                    if value_id is None:
+                        value_id = value_ids[value] = len(self.values)
+                        self.values.append(value)
+                    column[row] = value_id
+            columns.append(column)
+        self.columns = [[column.get(row, 0) for row in xrange(len(self.keys))] for column in columns]
+        self.numpy = None
+        if use_numpy:
+            try:
+                import numpy
+                self.numpy = numpy
+                self.columns = numpy.array(self.columns, dtype=numpy.int32).reshape(len(columns), len(self.keys))
+            except ImportError:
+                pass
+
+    def diverging_rows(self):
+        """Return the indexes of the rows in which any build differs from the first one, in (section, option) order."""
+        if self.numpy:
+            rows = self.numpy.flatnonzero((self.columns[1:] != self.columns[0]).any(axis=0)).tolist()
+        else:
+            reference = self.columns[0]
+            rows = set()
+            for column in self.columns[1:]:
+                rows.update(itertools.compress(xrange(len(column)), itertools.imap(operator.ne, reference, column)))
+        return sorted(rows, key=lambda row: self.keys[row])
+
+    def row_values(self, row):
+        """Return the values of a row in every build, None if absent."""
+        return [self.values[column[row]] for column in self.columns]
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 16), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def ini_digest(conf, ini_name, exceptions):
+    """Return a digest of the IniFile content normalized by sorting and leaving out ignored options."""
+    h = hashlib.sha1()
+    for section in sorted(conf.sections):
+        h.update('[%s]\n' % section)
+        options = conf.sections[section]
+        for option in sorted(options):
+            if exceptions.get(ini_name, section, option) != 'ignore':
+                h.update('%s=%s\n' % (option, options[option]))
+    return h.hexdigest()
+
+
+class Baseline:
+    """
+    Digests of the INI files of a project compared at the previous run along with the number of unequal
+    options found and the report of the comparison, stored in <baseline_dir>/<project>.json. Every record
+    holds [raw, normalized] digests of the file per obj folder, the normalized one is taken with ignored
+    options left out.
+    """
+    def __init__(self, baseline_dir, project_name):
+        self.path = os.path.join(baseline_dir, project_name + '.json')
+        self.records = dict()
+        self.new_records = dict()
+        try:
+            with open(self.path) as fp:
+                self.records = json.load(fp)
+        except (IOError, ValueError):
+            pass
+
+    def get(self, port, ini_name):
+        return self.records.get(port + '/' + ini_name)
+
+    def put(self, port, ini_name, record):
+        self.new_records[port + '/' + ini_name] = record
+
+    def save(self):
+        """Replace the stored records with the ones put at this run."""
+        baseline_dir = os.path.dirname(self.path)
+        make_dirs(baseline_dir)
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            json.dump(self.new_records, fp, sort_keys=True)
+        if os.path.exists(self.path) and sys.platform.startswith("win"):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+
+
+def check_ini(ini_dirs, ini_name, sink, baseline=False, record=None):
+    """
+    Compare the INI files and return (unequal_cnt, baseline_record). With 'baseline', the files are not
+    compared if their raw digests match the baseline 'record', or their normalized digests either match
+    the 'record' or each other; such files are reported as unchanged along with the report recorded
+    when they were compared.
+    """
+    if not baseline:
+        return compare_ini(ini_dirs, ini_name, sink), None
+    exceptions = get_exception_rules()
+    folder_names = get_folder_names(ini_dirs)
+    # records of the baselines written before the report was kept are compared again
+    if record and (record['rules'] != exceptions.digest or 'report' not in record or
+                   sorted(record['digests']) != sorted(folder_names.values())):
+        record = None
+    digests = dict((folder_names[ini_dir], [file_digest(os.path.join(ini_dir, ini_name)), None])
+                   for ini_dir in ini_dirs)
+    unequal_cnt = None
+    report = list()
+    inis = None
+    if record and all(record['digests'][folder][0] == digests[folder][0] for folder in digests):
+        # byte-identical to the baseline, the files are not even parsed
+        digests = record['digests']
+        unequal_cnt = record['unequal']
+        report = record['report']
+    else:
+        inis = dict((ini_dir, IniFile(os.path.join(ini_dir, ini_name))) for ini_dir in ini_dirs)
+        for ini_dir in ini_dirs:
+            digests[folder_names[ini_dir]][1] = ini_digest(inis[ini_dir], ini_name, exceptions)
+        if len(set(digest[1] for digest in digests.values())) == 1:
+            unequal_cnt = 0
+        elif record and all(record['digests'][folder][1] == digests[folder][1] for folder in digests):
+            unequal_cnt = record['unequal']
+            report = record['report']
+    if unequal_cnt is None:
+        recorder = RecordingSink(sink)
+        unequal_cnt = compare_ini(ini_dirs, ini_name, recorder, inis)
+        report = recorder.report
+    else:
+        sink.unchanged(ini_dirs, ini_name, unequal_cnt, report)
+    return unequal_cnt, dict(rules=exceptions.digest, digests=digests, unequal=unequal_cnt, report=report)
+
+
+@contextlib.contextmanager
+def capture_output():
+    """Redirect stdout and stderr to StringIO buffers in the 'with' block. Yield the (out, err) buffers."""
+    out = StringIO.StringIO()
+    err = StringIO.StringIO()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = out, err
+    try:
+        yield out, err
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+def check_ini_buffered(job):
+    """Worker of the check() pool. Run check_ini() and return its results along with the captured output."""
+    ini_dirs, ini_name, sink, baseline, record = job
+    with capture_output() as (out, err):
+        unequal_cnt, record = check_ini(ini_dirs, ini_name, sink, baseline, record)
+        # the sink is a copy of the one of check(), whatever it has buffered is lost unless flushed here
+        sink.flush()
+    return unequal_cnt, record, out.getvalue(), err.getvalue()
+
+
+def check(obj_dirs, sink=None, baseline=None, jobs=1):
+    """
+    Compare the INI files in common port folders of all 'obj_dirs' and return the number of INI files
+    with unequal options. With a Baseline, files unchanged since the previous run are not compared again.
+    With jobs > 1 the INI files are compared by a pool of worker processes, the output is printed
+    in the same order as in a serial run: by port, then by INI name.
+    """
+    if sink is None:
+        sink = TableSink()
     result = list()
     # build a list of port folders
     common_ports = set()
@@ -456,8 +1936,10 @@ def check(obj_dirs):
     if not len(common_ports):
         print('No common ports in ', obj_dirs, file=sys.stderr)
 
-    # iterate port folders
-    for port in common_ports:
+    # list (port, ini_name, ini_dirs) items to compare, port is printed before its first item,
+    # ini_name None marks a port without common ini files
+    items = list()
+    for port in sorted(common_ports):
         common_ini = set()
         for obj_dir in obj_dirs:
             port_dir = os.path.join(obj_dir, port)
@@ -470,58 +1952,958 @@ def check(obj_dirs):
                 common_ini = common_ini & ini_name
 
         if not len(common_ini):
-            print('Check: no common ini files', file=sys.stderr)
-        else:
-            print('\nComparing port: ', port)
-            for ini_name in common_ini:
-                print()
-                ini_dirs = set()
-                for obj_dir in obj_dirs:
-                    ini_dir = os.path.join(obj_dir, port)
-                    ini_dirs.add(ini_dir)
-                if compare_ini(ini_dirs, ini_name):
-                    result.append(ini_name)
+            items.append((port, None, None))
+        for ini_name in sorted(common_ini):
+            ini_dirs = set()
+            for obj_dir in obj_dirs:
+                ini_dir = os.path.join(obj_dir, port)
+                ini_dirs.add(ini_dir)
+            items.append((port, ini_name, ini_dirs))
+
+    def get_record(port, ini_name):
+        return baseline.get(port, ini_name) if baseline else None
+
+    # a worker of the --jobs pool is a daemon process which is not allowed to have children
+    pool = None
+    if jobs > 1:
+        import multiprocessing
+        if not multiprocessing.current_process().daemon:
+            pool = multiprocessing.Pool(processes=jobs)
+    if pool:
+        job_list = [(ini_dirs, ini_name, sink, bool(baseline), get_record(port, ini_name))
+                    for port, ini_name, ini_dirs in items if ini_name]
+        results = pool.imap(check_ini_buffered, job_list)
+    try:
+        cur_port = None
+        for port, ini_name, ini_dirs in items:
+            if not ini_name:
+                print('Check: no common ini files', file=sys.stderr)
+                continue
+            if port != cur_port:
+                print('\nComparing port: ', port)
+                cur_port = port
+            print()
+            if pool:
+                unequal_cnt, record, out, err = next(results)
+                sys.stdout.write(out)
+                sys.stderr.write(err)
+            else:
+                unequal_cnt, record = check_ini(ini_dirs, ini_name, sink, bool(baseline), get_record(port, ini_name))
+            if baseline:
+                baseline.put(port, ini_name, record)
+            if unequal_cnt:
+                result.append(ini_name)
+        if pool:
+            pool.close()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    sink.flush()
+    if baseline:
+        baseline.save()
     return len(result)
 
 
+def get_build_labels(obj_dirs):
+    """
+    Return a {obj_dir: label} dict of unique labels of the builds: the shortest path suffixes telling the folders
+    apart once the trailing path items common to all of them (e.g. obj/<project>) are dropped, so that
+    api/20261001/obj/P, api/20261002/obj/P and tde/obj/P are labeled 20261001, 20261002 and tde.
+    Raise ValueError if the folders can not be told apart.
+    """
+    paths = [os.path.realpath(obj_dir).split(os.sep) for obj_dir in obj_dirs]
+    common = 0
+    while all(len(path) > common + 1 for path in paths) and len(set(path[-common - 1] for path in paths)) == 1:
+        common += 1
+    paths = [path[:len(path) - common] for path in paths]
+    for size in range(1, max(len(path) for path in paths) + 1):
+        labels = ['/'.join(path[-size:]).lstrip('/') or '/' for path in paths]
+        if len(set(labels)) == len(labels):
+            return dict(zip(obj_dirs, labels))
+    raise ValueError('The obj folders can not be told apart: %s' % ', '.join(obj_dirs))
+
+
+def compare_builds(obj_dirs, all_options=False, use_numpy=True):
+    """
+    Compare the INI files in the port folders of all 'obj_dirs' against the ones in obj_dirs[0] using ValueMatrix.
+    Output a table per INI file listing the unequal options (all differing options with 'all_options')
+    with the diverging builds grouped by their value. Return a list of {status: set of (port, ini_name,
+    section, option)} dicts of the options diverging from obj_dirs[0] in every build.
+    """
+    labels = get_build_labels(obj_dirs)
+    names = [labels[obj_dir] for obj_dir in obj_dirs]
+    exceptions = get_exception_rules()
+    divergence = [collections.defaultdict(set) for obj_dir in obj_dirs]
+    ports = set()
+    for obj_dir in obj_dirs:
+        ports.update(port for port in next(os.walk(obj_dir))[1] if re.match(PORT_RX, port))
+    for port in sorted(ports):
+        # an INI file missing in a build is compared as an empty one
+        ini_names = set()
+        for obj_dir in obj_dirs:
+            port_dir = os.path.join(obj_dir, port)
+            if os.path.isdir(port_dir):
+                ini_names.update(name for name in os.listdir(port_dir) if re.match('[\w\.]+\.ini$', name))
+        for ini_name in sorted(ini_names):
+            configs = [IniFile(os.path.join(obj_dir, port, ini_name)) for obj_dir in obj_dirs]
+            matrix = ValueMatrix(configs, use_numpy)
+            table = Table('%s: %s' % (port, ini_name))
+            table.add_header(['', names[0], 'diverging builds', 'status'])
+            cur_section = None
+            for row in matrix.diverging_rows():
+                section, option = matrix.keys[row]
+                values = matrix.row_values(row)
+                status = exceptions.get(ini_name, section, option)
+                groups = collections.OrderedDict()
+                for name, value, build_divergence in zip(names[1:], values[1:], divergence[1:]):
+                    if value != values[0]:
+                        groups.setdefault(value, list()).append(name)
+                        build_divergence[status].add((port, ini_name, section, option))
+                if status != 'unequal' and not all_options:
+                    continue
+                if section != cur_section:
+                    table.add_row(Row([section]))
+                    cur_section = section
+                option_name = next(conf.option_name(option) for conf, value in zip(configs, values)
+                                   if value is not None)
+                builds = '; '.join('%s: %s' % (','.join(group), '-' if value is None else value)
+                                   for value, group in groups.iteritems())
+                color = {'unequal': 'Red', 'ignore': 'Grey', 'default': 'Blue'}.get(status, 'Default')
+                table.add_row(Row(['  ' + option_name, '-' if values[0] is None else values[0], builds, status],
+                                  font=color))
+            if cur_section:
+                table.add_sep()
+                table.output()
+    return divergence
+
+
+class Tracer:
+    """
+    Record the durations of pipeline stages as Chrome trace events, which can be loaded into
+    chrome://tracing or Perfetto. Events of all processes are appended to the trace file as JSON lines,
+    finish() converts them into a JSON trace object. The tracer does nothing until a path is given.
+    """
+    def __init__(self):
+        self.path = None
+        self._file = None
+
+    def enable(self, path):
+        """Append events to the trace file 'path' (None disables tracing)."""
+        if path != self.path:
+            self.path = path
+            self._file = AppendFile(path) if path else None
+
+    def start(self, path):
+        """Truncate the trace file and enable tracing to it."""
+        if path:
+            open(path, 'w').close()
+        self.enable(path)
+
+    def event(self, name, start, duration, cat='stage', tid=None, **args):
+        """Record a complete event. 'start' is a time.time() timestamp, 'duration' is in seconds."""
+        if not self._file:
+            return
+        event = dict(name=name, cat=cat, ph='X', ts=int(start * 1e6), dur=int(duration * 1e6),
+                     pid=os.getpid(), tid=tid or threading.current_thread().ident, args=args)
+        self._file.write(json.dumps(event) + '\n')
+
+    @contextlib.contextmanager
+    def stage(self, name, **args):
+        """Record the wall and CPU time of the code in the 'with' block."""
+        if not self._file:
+            yield
+            return
+        start = time.time()
+        cpu_start = sum(os.times()[:2])
+        try:
+            yield
+        finally:
+            args['cpu_ms'] = round((sum(os.times()[:2]) - cpu_start) * 1000, 3)
+            self.event(name, start, time.time() - start, **args)
+
+    def iterate(self, name, iterable, cat='stage'):
+        """Yield the items of 'iterable' recording the time spent to produce every item."""
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.event(name, start, time.time() - start, cat=cat)
+                return
+            self.event(name, start, time.time() - start, cat=cat, item=str(item))
+            yield item
+
+    def finish(self):
+        """Convert the recorded JSON lines into a JSON trace object."""
+        if not self.path:
+            return
+        with open(self.path) as fp:
+            events = [json.loads(line) for line in fp if line.strip()]
+        with open(self.path, 'w') as fp:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), fp)
+
+
+TRACER = Tracer()
+
+
+def process_project(LDXCMD_BIN, project_dir, args, recompile=True):
+    """
+    Run the whole convert/compile/check pipeline for a single project and return the number of files failed,
+    or 'timeout' if an external tool has not completed in args.timeout seconds. Without 'recompile' only
+    the check is run if the project has been compiled before.
+    """
+    project_name = os.path.split(project_dir)[-1]
+    print(project_name)
+    TRACER.enable(args.trace)
+
+    workspace = get_workspace(args)
+    workspace.acquire()
+    files_failed = None
+    try:
+        files_failed = build_and_check(LDXCMD_BIN, project_dir, workspace, args, recompile)
+    finally:
+        workspace.release(project_name, files_failed is None or bool(files_failed))
+    return files_failed
+
+
+def build_and_check(LDXCMD_BIN, project_dir, workspace, args, recompile=True):
+    """The pipeline of process_project() run in the Workspace 'workspace'."""
+    project_name = os.path.split(project_dir)[-1]
+    config_dir = workspace.project_dirs(project_name)[0]
+    obj_dirs = get_obj_dirs(workspace.root, project_name)
+    cache = None
+    restored = False
+    compiled = not recompile and all(os.path.isdir(obj_dir) for obj_dir in obj_dirs)
+    if not compiled and not args.no_cache:
+        with TRACER.stage('cache restore', project=project_name):
+            cache = BuildCache(args.cache_dir, args.cache_size * 1024 * 1024, toolchain_id(LDXCMD_BIN))
+            cache_key = cache.key(project_dir)
+            cache_targets = [('AutomationConfig', config_dir), ('py', obj_dirs[0]), ('tde', obj_dirs[1])]
+            restored = cache.restore(cache_key, cache_targets)
+    if compiled:
+        print('Compiled before.')
+    elif restored:
+        print('Restored from build cache.')
+    else:
+        ldxcmd = get_ldxcmd_driver(LDXCMD_BIN, args.ldxcmd_mode)
+        log_path = None
+        if args.log_dir:
+            make_dirs(args.log_dir)
+            log_path = os.path.join(args.log_dir, project_name + '.log')
+            open(log_path, 'w').close()
+        try:
+            # Convert TDE projects to AutomationConfig
+            with TRACER.stage('convert', project=project_name):
+                convert(ldxcmd, project_dir, config_dir, args.timeout, log_path)
+
+            # compile to *.ini files
+            with TRACER.stage('compile', project=project_name):
+                obj_dir_api, obj_dir_tde, api_errors = compile(ldxcmd, config_dir, workspace.root,
+                                                               overlap=args.overlap, handoff=args.obj_handoff,
+                                                               timeout=args.timeout, log_path=log_path)
+                obj_dirs = obj_dir_api, obj_dir_tde
+        except ToolTimeout as e:
+            # the project is reported as failed and the run goes on
+            print('Timeout: %s' % e, file=sys.stderr)
+            return 'timeout'
+        if cache and api_errors:
+            # a restored entry would hide the API errors at every later run
+            print('Not stored to build cache: API compilation errors.')
+        elif cache:
+            with TRACER.stage('cache store', project=project_name):
+                cache.store(cache_key, cache_targets)
+    workspace.add(project_name)
+    for obj_dir in obj_dirs:
+        print (obj_dir)
+    # every INI file is compared for the results database to hold the options of all of them at every run
+    baseline = Baseline(args.baseline, project_name) if args.baseline and not args.db else None
+    with TRACER.stage('check', project=project_name):
+        if args.profile:
+            return profile_call(os.path.join(args.profile, project_name + '.prof'),
+                                check, obj_dirs, get_report_sink(args), baseline, args.check_jobs)
+        return check(obj_dirs, get_report_sink(args), baseline, args.check_jobs)
+
+
+def profile_call(path, func, *args):
+    """Call 'func' under cProfile and dump the statistics to 'path'. Return the result of the call."""
+    make_dirs(os.path.dirname(path))
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        profiler.dump_stats(path)
+
+
+def process_project_buffered(job):
+    """
+    Worker of the --jobs pool. Run process_project() with stdout and stderr captured, so that
+    the output of every project can be printed by the parent in one piece.
+    """
+    index, LDXCMD_BIN, project_dir, args, recompile = job
+    files_failed = None
+    error = None
+    with capture_output() as (out, err):
+        try:
+            files_failed = process_project(LDXCMD_BIN, project_dir, args, recompile)
+        except Exception:
+            error = traceback.format_exc()
+    return index, os.path.split(project_dir)[-1], files_failed, out.getvalue(), err.getvalue(), error
+
+
+def process_projects(LDXCMD_BIN, path_list, args, recompile=True):
+    """
+    Process all projects in 'path_list' and return a list of (project_name, files_failed) items
+    in the order of 'path_list'. 'path_list' may be a generator, the processing of a project starts as soon as
+    it is yielded. With args.jobs > 1 the projects are processed by a pool of worker processes.
+    'recompile' is passed to process_project().
+    """
+    if args.jobs <= 1:
+        results = list()
+        for project_dir in path_list:
+            files_failed = process_project(LDXCMD_BIN, project_dir, args, recompile)
+            results.append((os.path.split(project_dir)[-1], files_failed))
+            print()
+        return results
+
+    import multiprocessing
+    results = dict()
+    pool = multiprocessing.Pool(processes=args.jobs)
+    try:
+        job_list = ((n, LDXCMD_BIN, project_dir, args, recompile) for n, project_dir in enumerate(path_list))
+        for index, project_name, files_failed, out, err, error in pool.imap_unordered(process_project_buffered,
+                                                                                       job_list):
+            sys.stdout.write(out)
+            sys.stderr.write(err)
+            if error:
+                sys.stderr.write(error)
+                raise Exception('An error occurred while processing project: %s' % project_name)
+            results[index] = (project_name, files_failed)
+            print()
+            sys.stdout.flush()
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return [results[index] for index in sorted(results)]
+
+
+def run_projects(LDXCMD_BIN, path_list, args, db=None, recompile=True):
+    """
+    Process the projects in 'path_list' reporting to a new report sink and return a list
+    of (project_name, files_failed) items. The results are also stored to the ResultsDb 'db'.
+    """
+    sink = get_report_sink(args)
+    sink.start()
+    results = list()
+    try:
+        for project_name, files_failed in process_projects(LDXCMD_BIN, path_list, args, recompile):
+            results.append((project_name, files_failed))
+            if db:
+                db.add_project(args.run_id, project_name, files_failed)
+    finally:
+        close_ldxcmd_drivers()
+    sink.finish()
+    return results
+
+
+#
+# Watch mode
+#
+class PollingWatcher:
+    """Watch folder trees and files for changes by comparing snapshots of file modification times and sizes."""
+    def __init__(self, paths, exclude=(), interval=1.0):
+        self.paths = paths
+        self.exclude = exclude
+        self.interval = interval
+        self._snapshot = self.snapshot()
+
+    def snapshot(self):
+        result = dict()
+        for path in self.paths:
+            file_list = [path]
+            if os.path.isdir(path):
+                file_list = list()
+                for root, dirs, files in os.walk(path):
+                    dirs[:] = [name for name in dirs if not is_excluded(os.path.join(root, name), self.exclude)]
+                    file_list.extend(os.path.join(root, name) for name in files)
+            for file_path in file_list:
+                try:
+                    st = os.stat(file_path)
+                    result[file_path] = (st.st_mtime, st.st_size)
+                except OSError:
+                    pass
+        return result
+
+    def changes(self):
+        """Wait for changes and return the set of the paths changed, created or removed."""
+        while True:
+            time.sleep(self.interval)
+            snapshot = self.snapshot()
+            changed = set(path for path in set(snapshot) | set(self._snapshot)
+                          if snapshot.get(path) != self._snapshot.get(path))
+            self._snapshot = snapshot
+            if changed:
+                return changed
+
+
+class InotifyWatcher:
+    """
+    Watch folder trees and files for changes with Linux inotify. Folders are watched recursively,
+    files are watched by their parent folder, in which the events of other entries are dropped.
+    Events coming within 'settle' seconds of each other are returned together.
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+            IN_DELETE_SELF | IN_MOVE_SELF)
+
+    def __init__(self, paths, exclude=(), settle=0.5):
+        import ctypes
+        import ctypes.util
+        self.paths = paths
+        self.exclude = exclude
+        self.settle = settle
+        self._watches = dict()
+        self._trees = set()
+        self._files = dict()
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0:
+            self._raise()
+        try:
+            for path in paths:
+                if os.path.isdir(path):
+                    self.add_tree(path)
+                else:
+                    self._files.setdefault(os.path.dirname(path), set()).add(os.path.basename(path))
+            for folder in self._files:
+                if folder not in self._trees:
+                    self.add(folder)
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def _raise(self, path=None):
+        import ctypes
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), path)
+
+    def add(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, path, self.MASK)
+        if wd < 0:
+            self._raise(path)
+        self._watches[wd] = path
+
+    def add_tree(self, path):
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [name for name in dirs if not is_excluded(os.path.join(root, name), self.exclude)]
+            self.add(root)
+            self._trees.add(root)
+
+    def _read_events(self):
+        import struct
+        data = os.read(self._fd, 1 << 16)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            # struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip('\0')
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                # events have been lost, anything may have changed
+                changed.update(self.paths)
+                continue
+            folder = self._watches.get(wd)
+            if folder is None:
+                continue
+            if mask & self.IN_IGNORED:
+                del self._watches[wd]
+                continue
+            # the parent folder of a watched file: other entries there are not watched
+            names = self._files.get(folder)
+            if name and names is not None and folder not in self._trees and name not in names:
+                continue
+            path = os.path.join(folder, name) if name else folder
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                if is_excluded(path, self.exclude):
+                    continue
+                try:
+                    self.add_tree(path)
+                except OSError:
+                    # the folder is already gone
+                    pass
+            changed.add(path)
+        return changed
+
+    def changes(self):
+        """Wait for changes and return the set of the paths changed, created or removed."""
+        import select
+        changed = set()
+        timeout = None
+        while True:
+            if not select.select([self._fd], [], [], timeout)[0]:
+                if changed:
+                    return changed
+                timeout = None
+                continue
+            changed.update(self._read_events())
+            timeout = self.settle
+
+
+def get_watcher(paths, exclude=(), interval=1.0):
+    """Return an InotifyWatcher of 'paths' where inotify is available, a PollingWatcher otherwise."""
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(paths, exclude)
+        except (OSError, AttributeError) as e:
+            print('inotify is not available (%s), polling for changes.' % e, file=sys.stderr)
+    return PollingWatcher(paths, exclude, interval)
+
+
+def is_subpath(path, folder):
+    return path == folder or path.startswith(folder + os.sep)
+
+
+def watch_projects(LDXCMD_BIN, args, results, db=None):
+    """
+    Watch the project tree, the exceptions folder and the toolchain and rerun the projects affected
+    by changes until interrupted. 'results' is a {project_dir: (project_name, files_failed)} dict of the last
+    results of all projects, updated in place and output after every rerun.
+    A changed project is compiled and checked again, a change of the exceptions only triggers a check
+    of all projects. A change of LdxCmd or swifttest restarts the whole run, since the swifttest module
+    loaded in the process can not be reloaded reliably.
+    """
+    test_path = os.path.abspath(args.test_path)
+    exceptions_dir = os.path.abspath(EXCEPTIONS_DIR)
+    toolchain = [os.path.abspath(LDXCMD_BIN)]
+    try:
+        import swifttest
+        module_path = os.path.abspath(swifttest.__file__)
+        if os.path.splitext(os.path.basename(module_path))[0] == '__init__':
+            toolchain.append(os.path.dirname(module_path))
+        else:
+            toolchain.append(os.path.splitext(module_path)[0] + '.py')
+    except ImportError:
+        pass
+    # the folders the pipeline writes to must not trigger reruns if they happen to be in the project tree
+    scratch_dir = get_workspace(args).root
+    exclude = args.exclude + [os.path.join(scratch_dir, name) for name in ('AutomationConfig', 'py', 'tde')]
+    if args.log_dir:
+        exclude.append(os.path.abspath(args.log_dir))
+    watcher = get_watcher([test_path, exceptions_dir] + toolchain, exclude, args.watch_interval)
+
+    banner = 'Watching %s for changes, press Ctrl+C to stop.' % args.test_path
+    print(banner)
+    sys.stdout.flush()
+    while True:
+        changed = set(os.path.abspath(path) for path in watcher.changes())
+        if any(is_subpath(path, tool) for path in changed for tool in toolchain):
+            print('Toolchain changed, restarting.')
+            sys.stdout.flush()
+            stop_compile_service()
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        recheck = any(is_subpath(path, exceptions_dir) for path in changed)
+        changed = [path for path in changed if is_subpath(path, test_path)]
+        if not changed and not recheck:
+            continue
+
+        try:
+            path_list = list(unique_projects(dig_tests(args.test_path, exclude=args.exclude)))
+        except DuplicateProject as e:
+            print(e, file=sys.stderr)
+            continue
+        for project_dir in set(results) - set(path_list):
+            del results[project_dir]
+        recompile_list = [project_dir for project_dir in path_list if project_dir not in results or
+                          any(is_subpath(os.path.abspath(path), os.path.abspath(project_dir)) for path in changed)]
+        recheck_list = [project_dir for project_dir in path_list if project_dir not in recompile_list] if recheck \
+            else list()
+        if recheck:
+            print('Exceptions changed.')
+            get_exception_rules(reload=True)
+        if db:
+            args.run_id = db.add_run(test_path)
+        for project_list, recompile in ((recompile_list, True), (recheck_list, False)):
+            if project_list:
+                results.update(zip(project_list, run_projects(LDXCMD_BIN, project_list, args, db, recompile)))
+        output_results([results[project_dir] for project_dir in path_list])
+        print(banner)
+        sys.stdout.flush()
+
+
+#
+# Sharding
+#
+def parse_shard(value):
+    """Parse the I/N value of --shard into an (I, N) tuple."""
+    match = re.match(r'^(\d+)/(\d+)$', value)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError('expected I/N with 1 <= I <= N: %s' % value)
+    return int(match.group(1)), int(match.group(2))
+
+
+def count_files(path):
+    return sum(len(files) for _, _, files in os.walk(path))
+
+
+def shard_projects(test_path, path_list, shard, shards):
+    """
+    Return a list of (index, project_dir) items of the projects in 'path_list' falling into shard 'shard' out of
+    'shards', 'index' being the position of the project in 'path_list'. Projects are assigned largest first
+    to the least loaded shard, the size of a project is its number of files. Ties are broken by a hash of the
+    project path relative to 'test_path', so that every machine computes the same split of the same tree.
+    """
+    projects = list()
+    for index, project_dir in enumerate(path_list):
+        rel_path = os.path.relpath(project_dir, test_path).replace(os.sep, '/')
+        projects.append((-count_files(project_dir), hashlib.md5(rel_path).hexdigest(), index, project_dir))
+    loads = [0] * shards
+    result = list()
+    for size, digest, index, project_dir in sorted(projects):
+        n = min(xrange(shards), key=lambda n: loads[n])
+        loads[n] -= size
+        if n == shard - 1:
+            result.append((index, project_dir))
+    return sorted(result)
+
+
+def write_shard_results(path, shard, projects_cnt, results):
+    """
+    Write the results of a shard: a list of (index, project_name, files_failed) items, 'projects_cnt'
+    is the number of projects in all shards.
+    """
+    with open(path, 'w') as fp:
+        json.dump(dict(shard=shard, projects=projects_cnt, results=results), fp, separators=(',', ':'))
+
+
+def get_merge_arg_parser():
+    parser = argparse.ArgumentParser(prog='test.py merge',
+                                     description='Combine the results files of all shards of a --shard run '
+                                                 'into the results of the whole run.')
+    parser.add_argument('shard_files', help='results files written by --shard runs', nargs='+')
+    return parser
+
+
+def merge(argv):
+    """The 'merge' command: output the total results of the shards and exit with the number of projects failed."""
+    args = get_merge_arg_parser().parse_args(argv)
+    shards = dict()
+    for path in args.shard_files:
+        with open(path) as fp:
+            shards[path] = json.load(fp)
+    shard_ids = sorted(tuple(data['shard']) for data in shards.values())
+    shards_cnt = shard_ids[0][1]
+    if shard_ids != [(n, shards_cnt) for n in range(1, shards_cnt + 1)]:
+        sys.exit('Expected results of shards 1/%d to %d/%d once each, got: %s'
+                 % (shards_cnt, shards_cnt, shards_cnt, ', '.join('%d/%d' % shard for shard in shard_ids)))
+    results = sorted(tuple(result) for data in shards.values() for result in data['results'])
+    projects_cnt = shards.values()[0]['projects']
+    if [result[0] for result in results] != range(projects_cnt):
+        sys.exit('The shards have %d results of %d projects' % (len(results), projects_cnt))
+    sys.exit(output_results([(project_name, files_failed) for index, project_name, files_failed in results]))
+
+
 #
 # Main
 #
-def main():
-    # build a set of test paths from the command line argument pointing to the root folder
+def get_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('test_path', help='path to folder containing TDE projects', type=str)
-    args = parser.parse_args()
-    path_list = dig_tests(args.test_path)
-    LDXCMD_BIN = find_ldxcmd()
-    result_table = Table('Total results')
-    result_table.add_header(['Project', 'Files failed'])
+    parser.add_argument('-j', '--jobs', help='number of projects to process in parallel (default: 1)',
+                        type=int, default=1)
+    parser.add_argument('--check-jobs', help='number of INI files of a project to compare in parallel, '
+                                             'ignored together with --jobs (default: 1)', type=int, default=1)
+    parser.add_argument('--overlap', help='run LdxCmd compilation concurrently with the API compilation',
+                        action='store_true')
+    parser.add_argument('--no-cache', help='always convert and compile projects ignoring the build cache',
+                        action='store_true')
+    parser.add_argument('--cache-dir', help='build cache folder (default: %(default)s)',
+                        type=str, default=BUILD_CACHE_DIR)
+    parser.add_argument('--cache-size', help='maximum size of the build cache in MB (default: %(default)s)',
+                        type=int, default=BUILD_CACHE_SIZE_MB)
+    parser.add_argument('--exclude', help='glob pattern of folder names or paths not to search for projects '
+                                          '(may be given several times)', action='append', default=[])
+    parser.add_argument('--format', help='format of the comparison report (default: %(default)s)',
+                        choices=sorted(REPORT_SINKS), default='table')
+    parser.add_argument('--output', help='report file for jsonl and junit formats '
+                                         '(default: report.jsonl or report.xml)', type=str)
+    parser.add_argument('--ldxcmd-mode', help='run a new LdxCmd process per command or keep a persistent '
+                                              'LdxCmd --server process per worker; persistent needs an LdxCmd '
+                                              'build supporting --server, which is checked at startup '
+                                              '(default: %(default)s)',
+                        choices=sorted(LDXCMD_DRIVERS), default='process')
+    parser.add_argument('--obj-handoff', help='transfer the obj tree compiled by LdxCmd to the tde folder by '
+                                              'copying, moving or hard-linking it (default: %(default)s)',
+                        choices=['copy', 'link', 'move'], default='copy')
+    parser.add_argument('--timeout', help='seconds an LdxCmd step may take before it is killed and the project '
+                                          'is reported as failed (default: no timeout)', type=float)
+    parser.add_argument('--max-tools', help='maximum number of external tools running at once across all jobs '
+                                            '(default: no limit)', type=int, default=0)
+    parser.add_argument('--log-dir', help='folder to write the output of external tools to, '
+                                          'one <project>.log per project', type=str)
+    parser.add_argument('--trace', help='write durations of the pipeline stages to a Chrome trace-event file',
+                        type=str)
+    parser.add_argument('--profile', help='profile the comparison of every project with cProfile and write '
+                                          'the statistics to <PROFILE>/<project>.prof', type=str)
+    parser.add_argument('--baseline', help='folder of INI digests of the previous run, INI files unchanged '
+                                           'since then are not compared again (ignored with --db)', type=str)
+    parser.add_argument('--db', help='SQLite database to store the comparison results of the run to, '
+                                     'see "%(prog)s query -h"', type=str)
+    parser.add_argument('--run-id', help='id of the run in the --db database (default: a new run)', type=int)
+    parser.add_argument('--shard', help='process only shard I out of N of the projects balanced by size and '
+                                        'write the results to --shard-output, see "%(prog)s merge -h"',
+                        type=parse_shard, metavar='I/N')
+    parser.add_argument('--shard-output', help='results file of the shard (default: shard-I-of-N.json)',
+                        type=str)
+    parser.add_argument('--api-workers', help='number of pre-forked processes compiling with the swifttest API, '
+                                              'shared by all --jobs workers (default: compile in the process of '
+                                              'the project)', type=int, default=0)
+    parser.add_argument('--scratch', help='folder to convert and compile the projects in, e.g. on a tmpfs like '
+                                          '/dev/shm/api_test (default: the current folder)', type=str, default='.')
+    parser.add_argument('--scratch-size', help='maximum scratch space in MB taken by the projects of the run, new '
+                                               'projects wait while it is exceeded (default: no limit)',
+                        type=int, default=0)
+    parser.add_argument('--keep', help='keep the AutomationConfig and obj folders of the projects passed, '
+                                       'only the ones of failed projects are kept by default (implied by --watch)',
+                        action='store_true')
+    parser.add_argument('--watch', help='keep watching the projects, the exceptions and the toolchain after the run '
+                                        'and rerun the projects affected by changes, a --format report file holds '
+                                        'the projects of the latest rerun', action='store_true')
+    parser.add_argument('--watch-interval', help='seconds between checks for changes where inotify is not '
+                                                 'available (default: %(default)s)', type=float, default=1.0)
+    return parser
 
-    projects_failed = 0
-    for project_dir in path_list:
-        project_name = os.path.split(project_dir)[-1]
-        print(project_name)
 
-        # Convert TDE projects to AutomationConfig
-        cur_dir = os.path.abspath(os.path.curdir)
-        config_dir = os.path.join(cur_dir, 'AutomationConfig', project_name)
-        convert(LDXCMD_BIN, project_dir, config_dir)
+def get_query_arg_parser():
+    parser = argparse.ArgumentParser(prog='test.py query',
+                                     description='Report the options which were unequal in the recent runs '
+                                                 'stored to a --db database.')
+    parser.add_argument('db', help='SQLite results database', type=str)
+    parser.add_argument('--last', help='number of the recent runs to report on (default: %(default)s)',
+                        type=int, default=30)
+    parser.add_argument('--status', help='status of the options to report (default: %(default)s)',
+                        choices=['default', 'ignore', 'unequal'], default='unequal')
+    parser.add_argument('--project', help='glob pattern of project names', type=str, default='*')
+    parser.add_argument('--ini', help='glob pattern of INI file names', type=str, default='*')
+    parser.add_argument('--min-runs', help='report only the options having the status in at least '
+                                           'MIN_RUNS of the runs (default: %(default)s)', type=int, default=1)
+    parser.add_argument('--flaky', help='report only the options having the status in some but not all runs '
+                                        'comparing their project', action='store_true')
+    return parser
 
-        # obj_dirs = '/Volumes/public/exchange/dabakumov/temp/api/py/obj/HTTP piplining auth and redirect', '/Volumes/public/exchange/dabakumov/temp/api/tde/obj/HTTP piplining auth and redirect'#, '/Volumes/public/exchange/dabakumov/temp/api/py/obj/HTTP pipelinig Apache'
-                   # '/Volumes/public/exchange/dabakumov/temp/api/py/obj/HTTP GET 10 files pipelined'
 
-        # compile to *.ini files
-        obj_dirs = compile(LDXCMD_BIN, config_dir, cur_dir)
-        for obj_dir in obj_dirs:
-            print (obj_dir)
-        files_failed = check(obj_dirs)
+def query(argv):
+    """
+    The 'query' command: a table of the options having the status in the last runs of the database,
+    with the number of runs they had it in out of the runs comparing their project.
+    """
+    args = get_query_arg_parser().parse_args(argv)
+    if not os.path.isfile(args.db):
+        sys.exit('No such database: %s' % args.db)
+    db = ResultsDb(args.db)
+    run_ids = [row[0] for row in db.conn.execute('SELECT id FROM runs ORDER BY id DESC LIMIT ?', (args.last,))]
+    runs = ', '.join(str(run_id) for run_id in run_ids)
+    project_runs = dict(db.conn.execute('SELECT project, COUNT(DISTINCT run_id) FROM run_projects '
+                                        'WHERE run_id IN (%s) GROUP BY project' % runs))
+    rows = db.conn.execute(
+        'SELECT project, port, ini, section, option, COUNT(DISTINCT run_id), MAX(run_id) FROM results '
+        'WHERE run_id IN (%s) AND status = ? AND project GLOB ? AND ini GLOB ? '
+        'GROUP BY project, port, ini, section, option '
+        'ORDER BY COUNT(DISTINCT run_id) DESC, project, port, ini, section, option' % runs,
+        (args.status, args.project, args.ini))
+
+    table = Table('Options %s in the last %d runs' % (args.status, len(run_ids)))
+    table.add_header(['Project', 'Port', 'INI', 'Section', 'Option', 'Runs', 'Last run'])
+    options_cnt = 0
+    for project, port, ini, section, option, runs_cnt, last_run in rows:
+        total = project_runs.get(project, runs_cnt)
+        if runs_cnt < args.min_runs or (args.flaky and runs_cnt >= total):
+            continue
+        table.add_row(Row([project, port, ini, section, option, '%d/%d' % (runs_cnt, total), last_run],
+                          font='Red' if runs_cnt >= total else 'Default'))
+        options_cnt += 1
+    db.close()
+    table.add_sep()
+    table.add_total('Options:', options_cnt)
+    table.output()
+
+
+def get_compare_arg_parser():
+    parser = argparse.ArgumentParser(prog='test.py compare',
+                                     description='Compare the INI files of obj folders of a project compiled '
+                                                 'before, e.g. py/obj/<project> and tde/obj/<project>, '
+                                                 'without converting or compiling anything.')
+    parser.add_argument('obj_dirs', help='obj folders holding the port folders of a project', nargs='+')
+    parser.add_argument('-j', '--check-jobs', help='number of INI files to compare in parallel (default: 1)',
+                        type=int, default=1)
+    parser.add_argument('--format', help='format of the comparison report (default: %(default)s)',
+                        choices=sorted(REPORT_SINKS), default='table')
+    parser.add_argument('--output', help='report file for jsonl and junit formats '
+                                         '(default: report.jsonl or report.xml)', type=str)
+    parser.add_argument('--baseline', help='folder of INI digests of the previous run, INI files unchanged '
+                                           'since then are not compared again', type=str)
+    parser.set_defaults(db=None, run_id=None)
+    return parser
+
+
+def compare(argv):
+    """The 'compare' command: run check() on existing obj folders and exit with the number of projects failed."""
+    parser = get_compare_arg_parser()
+    args = parser.parse_args(argv)
+    if len(args.obj_dirs) < 2:
+        parser.error('at least two obj folders are required')
+    for obj_dir in args.obj_dirs:
+        if not os.path.isdir(obj_dir):
+            parser.error('no such folder: %s' % obj_dir)
+    get_exception_rules()
+    sink = get_report_sink(args)
+    sink.start()
+    project_name = os.path.basename(os.path.normpath(args.obj_dirs[0]))
+    print(project_name)
+    baseline = Baseline(args.baseline, project_name) if args.baseline else None
+    files_failed = check(args.obj_dirs, sink, baseline, args.check_jobs)
+    sink.finish()
+    print()
+    sys.exit(output_results([(project_name, files_failed)]))
+
+
+def get_matrix_arg_parser():
+    parser = argparse.ArgumentParser(prog='test.py matrix',
+                                     description='Compare the INI files of a project compiled by many builds '
+                                                 'of the API against the TDE ones in a single pass and summarize '
+                                                 'which builds diverge from TDE.')
+    parser.add_argument('reference', help='obj folder of the project compiled by TDE, e.g. tde/obj/<project>')
+    parser.add_argument('obj_dirs', help='obj folders of the project compiled by the API builds, '
+                                         'in the order of the builds', nargs='+')
+    parser.add_argument('--all', help='list ignored and default options as well as unequal ones',
+                        action='store_true')
+    parser.add_argument('--no-numpy', help='compare the builds with lists even if NumPy is installed',
+                        action='store_true')
+    return parser
+
+
+def matrix(argv):
+    """
+    The 'matrix' command: output the options diverging from TDE per INI file and a summary of the unequal
+    options per build, including the ones new or fixed since the previous build. Exit with the number
+    of builds having unequal options.
+    """
+    args = get_matrix_arg_parser().parse_args(argv)
+    obj_dirs = [args.reference] + args.obj_dirs
+    for obj_dir in obj_dirs:
+        if not os.path.isdir(obj_dir):
+            sys.exit('No such folder: %s' % obj_dir)
+    try:
+        labels = get_build_labels(obj_dirs)
+    except ValueError as e:
+        sys.exit(str(e))
+    divergence = compare_builds(obj_dirs, args.all, not args.no_numpy)
+
+    table = Table('Builds diverging from %s' % labels[args.reference])
+    table.add_header(['Build', 'Unequal', 'New', 'Fixed', 'Ignored', 'Default'])
+    builds_failed = 0
+    previous = set()
+    for obj_dir, build_divergence in zip(args.obj_dirs, divergence[1:]):
+        unequal = build_divergence['unequal']
+        table.add_row(Row([labels[obj_dir], len(unequal), len(unequal - previous), len(previous - unequal),
+                           len(build_divergence['ignore']), len(build_divergence['default'])],
+                          align=Alignment.RIGHT, font='Red' if unequal else 'Default'))
+        builds_failed += int(bool(unequal))
+        previous = unequal
+    table.add_sep()
+    table.add_total('Builds diverging:', builds_failed)
+    table.output()
+    sys.exit(builds_failed)
 
+
+COMMANDS = {'compare': compare, 'matrix': matrix, 'merge': merge, 'query': query}
+
+
+def output_results(results):
+    """Output the table of (project_name, files_failed) results and return the number of projects failed."""
+    result_table = Table('Total results')
+    result_table.add_header(['Project', 'Files failed'])
+    projects_failed = 0
+    for project_name, files_failed in results:
         result_table.add_row(Row([project_name, files_failed], align=Alignment.RIGHT))
         projects_failed += int(bool(files_failed))
-        print()
     result_table.add_sep()
     result_table.add_total('Projects failed:', projects_failed)
     result_table.output()
+    return projects_failed
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+    # build a set of test paths from the command line argument pointing to the root folder
+    parser = get_arg_parser()
+    args = parser.parse_args()
+    if args.watch and args.shard:
+        parser.error('--watch can not be used with --shard')
+    if args.db and args.baseline:
+        print('--baseline is ignored with --db, every INI file is compared.', file=sys.stderr)
+    # reruns of passed projects after an exceptions change only re-compare their existing obj folders
+    args.keep = args.keep or args.watch
+    TRACER.start(args.trace)
+    path_list = TRACER.iterate('discover', unique_projects(dig_tests(args.test_path, exclude=args.exclude)),
+                               cat='discovery')
+    LDXCMD_BIN = find_ldxcmd()
+    # load exceptions and set up the tools limit once before the workers are forked
+    get_exception_rules()
+    set_tool_limit(args.max_tools)
+    if args.ldxcmd_mode == 'persistent':
+        PersistentLdxCmdDriver(LDXCMD_BIN).probe()
+    get_workspace(args)
+    if args.api_workers:
+        start_compile_service(args.api_workers)
+    db = None
+    if args.db:
+        db = ResultsDb(args.db)
+        if args.run_id is None:
+            args.run_id = db.add_run(os.path.abspath(args.test_path))
+    try:
+        if args.shard:
+            path_list = list(path_list)
+            projects_cnt = len(path_list)
+            indexes, path_list = zip(*shard_projects(args.test_path, path_list, *args.shard)) or ((), ())
+        elif args.watch:
+            path_list = list(path_list)
+        # a duplicate found while the projects are being processed stops the run before the duplicate is started
+        results = run_projects(LDXCMD_BIN, path_list, args, db)
+        if args.shard:
+            write_shard_results(args.shard_output or 'shard-%d-of-%d.json' % args.shard, args.shard, projects_cnt,
+                                [(index, ) + result for index, result in zip(indexes, results)])
+        projects_failed = output_results(results)
+        if args.watch:
+            results = collections.OrderedDict(zip(path_list, results))
+            try:
+                watch_projects(LDXCMD_BIN, args, results, db)
+            except KeyboardInterrupt:
+                projects_failed = sum(int(bool(files_failed)) for project_name, files_failed in results.values())
+        # the reruns of --watch append their events to the trace as well
+        TRACER.finish()
+    except DuplicateProject as e:
+        sys.exit(str(e))
+    finally:
+        stop_compile_service()
+    if db:
+        db.close()
     sys.exit(projects_failed)
 
 if __name__ == '__main__':